@@ -0,0 +1,147 @@
+import logging
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
+
+logger = logging.getLogger(__name__)
+
+
+class FeatureDataset(Dataset):
+    """
+    Unpadded (ragged) features: the token-level columns are stored back to back and example `i`
+    spans `offsets[i]:offsets[i + 1]`. Batches are padded by `collate` to their own longest example.
+    Args:
+        features: dict of arrays with `offsets`, `input_ids`, `token_type_ids`, `label_ids`
+            and optionally `entity_starts` (TLINK).
+        pad_token_id: Id used to pad input_ids.
+        pad_token_label_id: Label id used to pad token-level labels (ignored by the loss).
+        token_level_labels: True if `label_ids` has one label per token (NER), False for one per example.
+        pad_token_segment_id: Id used to pad token_type_ids.
+    """
+
+    def __init__(self, features, pad_token_id, pad_token_label_id=-100, token_level_labels=True, pad_token_segment_id=0):
+        self.features = features
+        self.offsets = features["offsets"]
+        self.lengths = np.diff(self.offsets)
+        self.pad_token_id = pad_token_id
+        self.pad_token_label_id = pad_token_label_id
+        self.token_level_labels = token_level_labels
+        self.pad_token_segment_id = pad_token_segment_id
+        self.has_entity_starts = "entity_starts" in features
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        label_ids = self.features["label_ids"][start:end] if self.token_level_labels else self.features["label_ids"][index]
+        entity_starts = self.features["entity_starts"][index] if self.has_entity_starts else None
+        return self.features["input_ids"][start:end], self.features["token_type_ids"][start:end], label_ids, entity_starts
+
+    def collate(self, examples):
+        """
+        Pads a list of examples to the longest one.
+        Returns:
+            (input_ids, attention_mask, token_type_ids, label_ids[, entity_starts]) tensors
+        """
+        batch_size = len(examples)
+        max_len = max(len(example[0]) for example in examples)
+
+        input_ids = np.full((batch_size, max_len), self.pad_token_id, dtype=np.int32)
+        attention_mask = np.zeros((batch_size, max_len), dtype=np.int32)
+        token_type_ids = np.full((batch_size, max_len), self.pad_token_segment_id, dtype=np.int32)
+        if self.token_level_labels:
+            label_ids = np.full((batch_size, max_len), self.pad_token_label_id, dtype=np.int64)
+        else:
+            label_ids = np.array([example[2] for example in examples], dtype=np.int64)
+
+        for i, (ex_input_ids, ex_token_type_ids, ex_label_ids, _) in enumerate(examples):
+            length = len(ex_input_ids)
+            input_ids[i, :length] = ex_input_ids
+            attention_mask[i, :length] = 1
+            token_type_ids[i, :length] = ex_token_type_ids
+            if self.token_level_labels:
+                label_ids[i, :length] = ex_label_ids
+
+        batch = (torch.from_numpy(input_ids), torch.from_numpy(attention_mask),
+                 torch.from_numpy(token_type_ids), torch.from_numpy(label_ids))
+        if self.has_entity_starts:
+            batch += (torch.from_numpy(np.array([example[3] for example in examples], dtype=np.int64)),)
+        return batch
+
+
+class LengthBucketSampler(Sampler):
+    """
+    Batch sampler that groups examples of similar length so that dynamic padding wastes little compute.
+    With shuffle, the examples are shuffled, cut into buckets of `batch_size * bucket_size` examples,
+    sorted by length inside each bucket and batched, and the batch order is shuffled again. Without
+    shuffle, all examples are sorted by length (for evaluation).
+    For distributed training every process builds the same batch list (same seed and epoch) and takes
+    every `num_replicas`-th batch from `rank` on; the list is first padded by repeating its first batches
+    so that every process runs the same number of steps.
+    Args:
+        lengths: Length of every example.
+        batch_size: Examples per batch.
+        shuffle: Whether to shuffle (training) or iterate in a fixed order (evaluation).
+        bucket_size: Number of batches per bucket.
+        seed: Base seed of the shuffling, combined with the epoch set by `set_epoch`.
+        drop_last: Drop the last incomplete batch.
+        num_replicas: Number of distributed processes sharing the batches.
+        rank: Rank of this process.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size=100, seed=42, drop_last=False,
+                 num_replicas=1, rank=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.start_batch = 0
+
+    def set_epoch(self, epoch, start_batch=0):
+        """
+        Args:
+            start_batch: Skip the first batches of the epoch (already trained on before resuming a checkpoint).
+        """
+        self.epoch = epoch
+        self.start_batch = start_batch
+
+    def _split(self, indices):
+        return [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+
+    def batches(self):
+        if not self.shuffle:
+            batches = self._split(np.argsort(self.lengths, kind="stable"))
+        else:
+            rng = np.random.RandomState(self.seed + self.epoch)
+            permutation = rng.permutation(len(self.lengths))
+            examples_per_bucket = self.batch_size * self.bucket_size
+            batches = []
+            for start in range(0, len(permutation), examples_per_bucket):
+                bucket = permutation[start:start + examples_per_bucket]
+                batches.extend(self._split(bucket[np.argsort(self.lengths[bucket], kind="stable")]))
+            rng.shuffle(batches)
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.num_replicas > 1 and batches:
+            num_batches = len(batches) + -len(batches) % self.num_replicas
+            batches = [batches[i % len(batches)] for i in range(self.rank, num_batches, self.num_replicas)]
+        return batches
+
+    def __iter__(self):
+        for batch in self.batches()[self.start_batch:]:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            num_batches = len(self.lengths) // self.batch_size
+        else:
+            num_batches = (len(self.lengths) + self.batch_size - 1) // self.batch_size
+        # Batches of this process left in the epoch (`__iter__` skips the first start_batch)
+        return max((num_batches + self.num_replicas - 1) // self.num_replicas - self.start_batch, 0)
@@ -0,0 +1,222 @@
+import os
+import re
+import random
+import time
+import shutil
+import logging
+import tempfile
+import threading
+
+import numpy as np
+import torch
+
+from distributed import is_main_process, get_rank, get_world_size, all_gather_object
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_PREFIX = "checkpoint-"
+TRAINING_STATE_NAME = "training_state.bin"
+
+
+class AsyncCheckpointWriter(object):
+    """
+    Writes checkpoints on a background thread, so the training loop does not stall on disk or network
+    filesystem I/O. The caller hands over a CPU snapshot (`snapshot_to_cpu`) and keeps training on the
+    live tensors meanwhile. The writes run one at a time, in submission order. Up to `max_pending` of them
+    may be queued or running (e.g. the model and the training checkpoint of a step where save_steps and
+    checkpoint_steps coincide); beyond that `submit` first waits for the oldest one (back-pressure).
+    `submit`/`wait` re-raise the error of a write that failed.
+    Args:
+        max_pending: Writes (and so CPU snapshots) held at once before `submit` blocks.
+    """
+
+    def __init__(self, max_pending=2):
+        self.max_pending = max_pending
+        self._threads = []
+        self._error = None
+
+    def submit(self, description, fn, *args, **kwargs):
+        """Runs `fn(*args, **kwargs)` on a writer thread; `description` names the write in the logs."""
+        while len(self._threads) >= self.max_pending:
+            self._join_oldest()
+        self._raise_error()
+        previous = self._threads[-1] if self._threads else None
+
+        def run():
+            # Keeps the writes in order (e.g. the checkpoint rotation)
+            if previous is not None:
+                previous.join()
+            start = time.time()
+            try:
+                fn(*args, **kwargs)
+            except BaseException as e:
+                logger.error("Writing %s failed: %s", description, e)
+                self._error = e
+            else:
+                logger.info("Wrote %s in %.1fs", description, time.time() - start)
+
+        # Not a daemon: the interpreter lets a pending write finish before exiting
+        thread = threading.Thread(target=run, name="checkpoint-writer")
+        thread.start()
+        self._threads.append(thread)
+
+    def _join_oldest(self):
+        thread = self._threads.pop(0)
+        if thread.is_alive():
+            logger.info("Waiting for a previous checkpoint write to finish")
+        thread.join()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Writing a checkpoint in the background failed") from error
+
+    def wait(self):
+        """Blocks until the pending writes (if any) are on disk."""
+        while self._threads:
+            self._join_oldest()
+        self._raise_error()
+
+
+def snapshot_to_cpu(obj):
+    """Copies the tensors of a (nested) state dict to CPU memory, so that training can go on updating the originals."""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot_to_cpu(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(value) for value in obj)
+    return obj
+
+
+def get_rng_state():
+    """RNG states of Python, NumPy and torch (CPU and every visible GPU)."""
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def list_checkpoints(checkpoint_dir):
+    """Returns the `checkpoint-<global_step>` directories in `checkpoint_dir`, oldest first."""
+    if not os.path.isdir(checkpoint_dir):
+        return []
+    checkpoints = []
+    for name in os.listdir(checkpoint_dir):
+        match = re.fullmatch(re.escape(CHECKPOINT_PREFIX) + r"(\d+)", name)
+        if match and os.path.isfile(os.path.join(checkpoint_dir, name, TRAINING_STATE_NAME)):
+            checkpoints.append((int(match.group(1)), os.path.join(checkpoint_dir, name)))
+    return [path for _, path in sorted(checkpoints)]
+
+
+def latest_checkpoint(checkpoint_dir):
+    checkpoints = list_checkpoints(checkpoint_dir)
+    return checkpoints[-1] if checkpoints else None
+
+
+def save_checkpoint(checkpoint_dir, state, keep_last=2):
+    """
+    Writes a full training state (model, optimizer, scheduler, counters, RNG states) as
+    `checkpoint_dir/checkpoint-<global_step>`. The checkpoint is written into a temporary directory
+    and renamed into place, so a pre-empted job never leaves a partial checkpoint behind; then all
+    but the `keep_last` most recent checkpoints are deleted.
+    Args:
+        state: dict with at least `global_step`; tensors are saved with `torch.save`.
+        keep_last: Number of checkpoints to keep (0 keeps all of them).
+    Returns:
+        The checkpoint directory
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    path = os.path.join(checkpoint_dir, "{}{}".format(CHECKPOINT_PREFIX, state["global_step"]))
+    tmp_dir = tempfile.mkdtemp(prefix=CHECKPOINT_PREFIX, suffix=".tmp", dir=checkpoint_dir)
+    try:
+        torch.save(state, os.path.join(tmp_dir, TRAINING_STATE_NAME))
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp_dir, path)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    logger.info("Saved training checkpoint %s", path)
+
+    # Leftovers of writes that were killed midway
+    for name in os.listdir(checkpoint_dir):
+        if name.startswith(CHECKPOINT_PREFIX) and name.endswith(".tmp"):
+            shutil.rmtree(os.path.join(checkpoint_dir, name), ignore_errors=True)
+    if keep_last > 0:
+        for old_path in list_checkpoints(checkpoint_dir)[:-keep_last]:
+            shutil.rmtree(old_path, ignore_errors=True)
+            logger.info("Deleted old checkpoint %s", old_path)
+    return path
+
+
+def load_checkpoint(path, map_location="cpu"):
+    # The state holds NumPy/Python RNG states besides tensors, so it is not a weights-only file
+    return torch.load(os.path.join(path, TRAINING_STATE_NAME), map_location=map_location, weights_only=False)
+
+
+def save_training_checkpoint(checkpoint_dir, model, optimizer, scheduler, precision, counters, keep_last=2, writer=None):
+    """
+    Saves everything needed to continue training exactly where it stopped. Under DDP every process
+    has to call it: each one hands its own RNG states (and running loss) to the main process, which writes.
+    Args:
+        model: The unwrapped model.
+        precision: MixedPrecision of the trainer (its loss scale for fp16).
+        counters: global_step, epoch, batch_in_epoch (batches of the epoch already trained on), tr_loss,
+            and the early stopping trigger_times, last_loss and to_stop.
+        writer: AsyncCheckpointWriter to write a CPU snapshot of the state in the background.
+    Returns:
+        The checkpoint directory (None on the other processes)
+    """
+    rank_states = all_gather_object({"rng": get_rng_state(), "tr_loss": counters["tr_loss"]})
+    if not is_main_process():
+        return None
+    state = dict(counters,
+                 model=model.state_dict(),
+                 optimizer=optimizer.state_dict(),
+                 scheduler=scheduler.state_dict(),
+                 precision=precision.state_dict(),
+                 rank_states=rank_states)
+    if writer is None:
+        return save_checkpoint(checkpoint_dir, state, keep_last)
+    path = os.path.join(checkpoint_dir, "{}{}".format(CHECKPOINT_PREFIX, state["global_step"]))
+    writer.submit("training checkpoint {}".format(path), save_checkpoint, checkpoint_dir, snapshot_to_cpu(state), keep_last)
+    return path
+
+
+def restore_training_checkpoint(path, model, optimizer, scheduler, precision):
+    """
+    Loads a checkpoint of `save_training_checkpoint` into the model, optimizer, scheduler and precision,
+    and restores this process's RNG states; call it right before the training loop.
+    Returns:
+        The counters of the checkpoint
+    """
+    state = load_checkpoint(path)
+    model.load_state_dict(state.pop("model"))
+    optimizer.load_state_dict(state.pop("optimizer"))
+    scheduler.load_state_dict(state.pop("scheduler"))
+    precision.load_state_dict(state.pop("precision"))
+
+    rank_states = state.pop("rank_states")
+    if len(rank_states) == get_world_size():
+        rank_state = rank_states[get_rank()]
+    else:
+        logger.warning("Checkpoint was written by %d processes, not %d: resuming with the RNG states of rank 0",
+                       len(rank_states), get_world_size())
+        rank_state = rank_states[0]
+    state["tr_loss"] = rank_state["tr_loss"]
+    set_rng_state(rank_state["rng"])
+
+    logger.info("Resumed training from %s (global step %d, epoch %d, batch %d)",
+                path, state["global_step"], state["epoch"], state["batch_in_epoch"])
+    return state
@@ -1,12 +1,18 @@
 import os
 import copy
 import json
+import array
 import logging
 
+import numpy as np
 import torch
-from torch.utils.data import TensorDataset
 
-from utils import get_labels
+from label_vocab import get_label_vocab, UnknownLabelCounter
+from token_cache import get_token_cache
+from feature_cache import feature_cache_key, cached_features_path, FeatureStoreWriter, load_features
+from featurize import featurize_to_store
+from distributed import main_process_first
+from batching import FeatureDataset
 import pdb
 
 logger = logging.getLogger(__name__)
@@ -39,55 +45,31 @@ class InputExample(object):
         return json.dumps(self.to_dict(), indent=2, sort_keys=True) + "\n"
 
 
-class InputFeatures(object):
-    """A single set of features of data."""
-
-    def __init__(self, input_ids, attention_mask, token_type_ids, label_ids):
-        self.input_ids = input_ids
-        self.attention_mask = attention_mask
-        self.token_type_ids = token_type_ids
-        self.label_ids = label_ids
-
-    def __repr__(self):
-        return str(self.to_json_string())
-
-    def to_dict(self):
-        """Serializes this instance to a Python dictionary."""
-        output = copy.deepcopy(self.__dict__)
-        return output
-
-    def to_json_string(self):
-        """Serializes this instance to a JSON string."""
-        return json.dumps(self.to_dict(), indent=2, sort_keys=True) + "\n"
-
 class NaverNerProcessor(object):
     """Processor for the Naver NER data set """
 
     def __init__(self, args):
         self.args = args
-        self.labels_lst = get_labels(args)
+        self.label_vocab = get_label_vocab(args)
+        self.labels_lst = self.label_vocab.labels
 
     @classmethod
     def _read_file(cls, input_file):
-        """Read tsv file, and return words and label as list"""
+        """Read tsv file lazily, and yield one stripped line at a time"""
         with open(input_file, "r", encoding="utf-8") as f:
-            lines = []
             for line in f:
-                lines.append(line.strip())
-            return lines
+                yield line.strip()
 
     def _create_examples(self, dataset, set_type):
-        """Creates examples for the training and dev sets."""
-        examples = []
+        """Creates examples for the training and dev sets, one line at a time."""
+        unk_counter = UnknownLabelCounter()
         for (i, data) in enumerate(dataset):
             words, labels = data.split('\t')
             words = list(words) # words.split()
             labels = labels.split()
             guid = "%s-%s" % (set_type, i)
 
-            labels_idx = []
-            for label in labels:
-                labels_idx.append(self.labels_lst.index(label) if label in self.labels_lst else self.labels_lst.index("UNK"))
+            labels_idx = [self.label_vocab.label_to_id(label, unk_counter) for label in labels]
 
             if len(words) != len(labels_idx):
                 print(words)
@@ -95,10 +77,10 @@ class NaverNerProcessor(object):
 
             if i % 10000 == 0:
                 logger.info(data)
-            examples.append(InputExample(guid=guid, words=words, labels=labels_idx))
-        return examples
+            yield InputExample(guid=guid, words=words, labels=labels_idx)
+        unk_counter.log(set_type)
 
-    def get_examples(self, mode):
+    def get_input_file(self, mode):
         """
         Args:
             mode: train, dev, test
@@ -110,9 +92,26 @@ class NaverNerProcessor(object):
             file_to_read = self.args["val_file"]
         elif mode == 'test':
             file_to_read = self.args["test_file"]
+        else:
+            raise Exception("For mode, Only train, dev, test is available")
+        return os.path.join(self.args["data_dir"], file_to_read)
 
-        logger.info("LOOKING AT {}".format(os.path.join(self.args["data_dir"], file_to_read)))
-        return self._create_examples(self._read_file(os.path.join(self.args["data_dir"], file_to_read)), mode)
+    def iter_examples(self, mode):
+        """
+        Streams the examples of a split without holding the file in memory.
+        Args:
+            mode: train, dev, test
+        """
+        input_file = self.get_input_file(mode)
+        logger.info("LOOKING AT {}".format(input_file))
+        return self._create_examples(self._read_file(input_file), mode)
+
+    def get_examples(self, mode):
+        """
+        Args:
+            mode: train, dev, test
+        """
+        return list(self.iter_examples(mode))
 
 
 processors = {
@@ -123,117 +122,113 @@ processors = {
 def convert_examples_to_features(examples, max_seq_len, tokenizer,
                                  pad_token_label_id=-100,
                                  cls_token_segment_id=0,
-                                 pad_token_segment_id=0,
                                  sequence_a_segment_id=0,
-                                 mask_padding_with_zero=True):
-    # Setting based on the current model type
-    cls_token = tokenizer.cls_token
-    sep_token = tokenizer.sep_token
-    unk_token = tokenizer.unk_token
-    pad_token_id = tokenizer.pad_token_id
-
-    features = []
+                                 token_cache=None,
+                                 start_index=0):
+    """
+    Converts examples into unpadded feature arrays; example `i` spans `offsets[i]:offsets[i + 1]`.
+    Padding (and the attention mask) is added per batch by `batching.FeatureDataset.collate`.
+    Args:
+        start_index: Index of the first example in the split, when converting one chunk of a split.
+    Returns:
+        dict of numpy arrays: offsets ([num_examples + 1], int64), input_ids, token_type_ids
+        ([num_tokens], int32) and label_ids ([num_tokens], int64)
+    """
+    num_examples = len(examples)
+    if token_cache is None:
+        token_cache = get_token_cache(tokenizer)
+
+    cls_token_id = tokenizer.cls_token_id
+    sep_token_id = tokenizer.sep_token_id
+    input_ids = array.array("i")
+    label_ids = array.array("q")
+    offsets = np.zeros(num_examples + 1, dtype=np.int64)
+
+    # Tokenize the words of the chunk that are not cached yet in one batch
+    token_cache.prefetch(word for example in examples for word in example.words)
+
+    # Account for [CLS] and [SEP]
+    special_tokens_count = 2
+    max_tokens = max_seq_len - special_tokens_count
     for (ex_index, example) in enumerate(examples):
         if ex_index % 5000 == 0:
-            logger.info("Writing example %d of %d" % (ex_index, len(examples)))
+            logger.info("Writing example %d of chunk %d-%d" % (start_index + ex_index, start_index,
+                                                              start_index + num_examples))
 
-        # Tokenize word by word (for NER)
-        tokens = []
-        label_ids = []
+        # Tokenize word by word (for NER), after the [CLS] token
+        ex_input_ids = [cls_token_id]
+        ex_label_ids = [pad_token_label_id]
         for word, slot_label in zip(example.words, example.labels):
-            word_tokens = tokenizer.tokenize(word)
-            if not word_tokens:
-                word_tokens = [unk_token]  # For handling the bad-encoded word
-            tokens.extend(word_tokens)
+            word_ids = token_cache.lookup(word)
+            ex_input_ids.extend(word_ids)
             # Use the real label id for the first token of the word, and padding ids for the remaining tokens
-            label_ids.extend([int(slot_label)] + [pad_token_label_id] * (len(word_tokens) - 1))
-
-        # Account for [CLS] and [SEP]
-        special_tokens_count = 2
-        if len(tokens) > max_seq_len - special_tokens_count:
-            tokens = tokens[: (max_seq_len - special_tokens_count)]
-            label_ids = label_ids[: (max_seq_len - special_tokens_count)]
-
-        # Add [SEP] token
-        tokens += [sep_token]
-        label_ids += [pad_token_label_id]
-        token_type_ids = [sequence_a_segment_id] * len(tokens)
-
-        # Add [CLS] token
-        tokens = [cls_token] + tokens
-        label_ids = [pad_token_label_id] + label_ids
-        token_type_ids = [cls_token_segment_id] + token_type_ids
-
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        attention_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
-
-        # Zero-pad up to the sequence length.
-        padding_length = max_seq_len - len(input_ids)
-        input_ids = input_ids + ([pad_token_id] * padding_length)
-        attention_mask = attention_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
-        token_type_ids = token_type_ids + ([pad_token_segment_id] * padding_length)
-        label_ids = label_ids + ([pad_token_label_id] * padding_length)
-
-        assert len(input_ids) == max_seq_len, "Error with input length {} vs {}".format(len(input_ids), max_seq_len)
-        assert len(attention_mask) == max_seq_len, "Error with attention mask length {} vs {}".format(len(attention_mask), max_seq_len)
-        assert len(token_type_ids) == max_seq_len, "Error with token type length {} vs {}".format(len(token_type_ids), max_seq_len)
-        assert len(label_ids) == max_seq_len, "Error with slot labels length {} vs {}".format(len(label_ids), max_seq_len)
-
-        if ex_index < 5:
-            logger.info("*** Example ***")
-            logger.info("guid: %s" % example.guid)
-            logger.info("tokens: %s" % " ".join([str(x) for x in tokens]))
-            logger.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-            logger.info("attention_mask: %s" % " ".join([str(x) for x in attention_mask]))
-            logger.info("token_type_ids: %s" % " ".join([str(x) for x in token_type_ids]))
-            logger.info("label: %s " % " ".join([str(x) for x in label_ids]))
-
-        features.append(
-            InputFeatures(input_ids=input_ids,
-                          attention_mask=attention_mask,
-                          token_type_ids=token_type_ids,
-                          label_ids=label_ids
-                          ))
-
-    return features
+            ex_label_ids.append(int(slot_label))
+            ex_label_ids.extend([pad_token_label_id] * (len(word_ids) - 1))
+            if len(ex_input_ids) > max_tokens:
+                break
+
+        # Truncate and add [SEP] token
+        del ex_input_ids[max_tokens + 1:]
+        del ex_label_ids[max_tokens + 1:]
+        ex_input_ids.append(sep_token_id)
+        ex_label_ids.append(pad_token_label_id)
+
+        input_ids.extend(ex_input_ids)
+        label_ids.extend(ex_label_ids)
+        offsets[ex_index + 1] = len(input_ids)
+
+    input_ids = np.frombuffer(input_ids, dtype=np.int32)
+    label_ids = np.frombuffer(label_ids, dtype=np.int64)
+    token_type_ids = np.full(len(input_ids), sequence_a_segment_id, dtype=np.int32)
+    token_type_ids[offsets[:-1]] = cls_token_segment_id
+
+    for ex_index in range(min(5, num_examples) if start_index == 0 else 0):
+        start, end = offsets[ex_index], offsets[ex_index + 1]
+        logger.info("*** Example ***")
+        logger.info("guid: %s" % examples[ex_index].guid)
+        logger.info("tokens: %s" % " ".join(tokenizer.convert_ids_to_tokens(input_ids[start:end].tolist())))
+        logger.info("input_ids: %s" % " ".join([str(x) for x in input_ids[start:end]]))
+        logger.info("token_type_ids: %s" % " ".join([str(x) for x in token_type_ids[start:end]]))
+        logger.info("label: %s " % " ".join([str(x) for x in label_ids[start:end]]))
+
+    return {
+        "offsets": offsets,
+        "input_ids": input_ids,
+        "token_type_ids": token_type_ids,
+        "label_ids": label_ids
+    }
 
 
 def load_and_cache_examples(args, tokenizer, mode, use_cache=True):
     processor = processors[args["task"]](args)
 
-    # Load data features from cache or dataset file
-    cached_file_name = 'cached_{}_{}_{}_{}'.format(
-        args["task"], list(filter(None, args["model_name_or_path"].split("/"))).pop(), args["max_seq_len"], mode)
-
     pad_token_label_id = torch.nn.CrossEntropyLoss().ignore_index
-    cached_features_file = os.path.join(args["data_dir"], cached_file_name)
-    if os.path.exists(cached_features_file) and use_cache:
-        logger.info("Loading features from cached file %s", cached_features_file)
-        features = torch.load(cached_features_file)
-    else:
-        logger.info("Creating features from dataset file at %s", args["data_dir"])
-        if mode == "train":
-            examples = processor.get_examples("train")
-        elif mode == "dev":
-            examples = processor.get_examples("dev")
-        elif mode == "test":
-            examples = processor.get_examples("test")
-        else:
-            raise Exception("For mode, Only train, dev, test is available")
 
-        features = convert_examples_to_features(examples, args["max_seq_len"], tokenizer, pad_token_label_id=pad_token_label_id)
-        logger.info("Saving features into cached file %s", cached_features_file)
-        torch.save(features, cached_features_file)
-
-    # Convert to Tensors and build dataset
-    all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-    all_attention_mask = torch.tensor([f.attention_mask for f in features], dtype=torch.long)
-    all_token_type_ids = torch.tensor([f.token_type_ids for f in features], dtype=torch.long)
-    all_label_ids = torch.tensor([f.label_ids for f in features], dtype=torch.long)
-
-    dataset = TensorDataset(all_input_ids, all_attention_mask, all_token_type_ids, all_label_ids)
+    # Load data features from cache or dataset file. The cache is keyed on the content of
+    # everything that goes into the features, so a stale file is never picked up.
+    cache_key = feature_cache_key(processor.get_input_file(mode), processor.labels_lst, tokenizer,
+                                  task=args["task"], max_seq_len=args["max_seq_len"],
+                                  pad_token_label_id=pad_token_label_id)
+    cached_features_file = cached_features_path(args, mode, cache_key)
+    # Under torchrun the main process builds the store first; the others then just open it
+    with main_process_first():
+        if os.path.exists(cached_features_file) and use_cache:
+            logger.info("Loading features from cached file %s", cached_features_file)
+            features = load_features(cached_features_file)
+        else:
+            logger.info("Creating features from dataset file at %s", args["data_dir"])
+            # Stream read -> parse -> tokenize -> featurize -> write, one chunk of examples at a time,
+            # with the chunks converted in parallel by featurize_workers processes
+            logger.info("Saving features into cached file %s", cached_features_file)
+            with FeatureStoreWriter(cached_features_file) as writer:
+                featurize_to_store(processor.iter_examples(mode), writer, convert_examples_to_features, tokenizer,
+                                   args["max_seq_len"], args["feature_chunk_size"],
+                                   num_workers=args["featurize_workers"], token_cache_size=args["token_cache_size"],
+                                   warm_token_cache=True, pad_token_label_id=pad_token_label_id)
+            # Open the finished store memory-mapped; only a few chunks were ever held in memory
+            features = load_features(cached_features_file)
+
+    # Wrap the memory-mapped columns (no copy); batches are padded on the fly
+    dataset = FeatureDataset(features, tokenizer.pad_token_id, pad_token_label_id=pad_token_label_id,
+                             token_level_labels=True)
     return dataset
-
@@ -0,0 +1,83 @@
+import os
+import logging
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+logger = logging.getLogger(__name__)
+
+
+def init_distributed(backend="gloo"):
+    """
+    Joins the process group when launched by torchrun (WORLD_SIZE > 1 in the environment).
+    gloo runs on CPU-only hosts; nccl needs one GPU per process.
+    Returns:
+        True if training is distributed
+    """
+    if int(os.environ.get("WORLD_SIZE", 1)) <= 1:
+        return False
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+        if backend == "nccl":
+            torch.cuda.set_device(get_local_rank())
+        logger.info("Joined the %s process group as rank %d of %d", backend, get_rank(), get_world_size())
+    return True
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def get_local_rank():
+    return int(os.environ.get("LOCAL_RANK", 0))
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+@contextmanager
+def main_process_first():
+    """The main process runs the block first (e.g. to build a feature cache), then the others run it."""
+    if not is_main_process():
+        barrier()
+    try:
+        yield
+    finally:
+        if is_main_process():
+            barrier()
+
+
+def all_reduce_sum(array):
+    """Sums a NumPy array over all processes (a no-op when not distributed)."""
+    if not is_distributed():
+        return array
+    tensor = torch.from_numpy(np.ascontiguousarray(array))
+    if dist.get_backend() == "nccl":
+        tensor = tensor.cuda()
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.cpu().numpy()
+
+
+def all_gather_object(obj):
+    """Gathers a picklable object from every process into a list indexed by rank."""
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
@@ -0,0 +1,171 @@
+import os
+import json
+import hashlib
+import logging
+import shutil
+import tempfile
+import itertools
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the layout of the cached features changes
+FEATURE_CACHE_VERSION = 3
+
+
+def _update_with_file(hasher, path, chunk_size=1 << 20):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+
+
+def tokenizer_fingerprint(tokenizer):
+    """Hash of everything in the tokenizer that changes the produced ids (vocab, added/special tokens, sp model)."""
+    hasher = hashlib.sha256()
+    hasher.update(type(tokenizer).__name__.encode("utf-8"))
+    hasher.update(json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False).encode("utf-8"))
+    hasher.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    hasher.update(str(getattr(tokenizer, "do_lower_case", None)).encode("utf-8"))
+    vocab_file = getattr(tokenizer, "vocab_file", None)
+    if vocab_file and os.path.isfile(vocab_file):
+        _update_with_file(hasher, vocab_file)
+    return hasher.hexdigest()
+
+
+def feature_cache_key(input_file, labels, tokenizer, **params):
+    """
+    Content address of a feature file.
+    Args:
+        input_file: Data file the features are built from (hashed by content, not by name).
+        labels: The label list, in label id order.
+        tokenizer: The tokenizer used for conversion, including any added special tokens.
+        params: Conversion parameters (max_seq_len, pad_token_label_id, ...).
+    """
+    hasher = hashlib.sha256()
+    hasher.update("v{}".format(FEATURE_CACHE_VERSION).encode("utf-8"))
+    _update_with_file(hasher, input_file)
+    hasher.update(json.dumps(list(labels), ensure_ascii=False).encode("utf-8"))
+    hasher.update(tokenizer_fingerprint(tokenizer).encode("utf-8"))
+    hasher.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def iter_chunks(iterable, chunk_size):
+    """Yields lists of up to `chunk_size` consecutive items of `iterable`, consuming it lazily."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def cached_features_path(args, mode, key):
+    cached_file_name = 'cached_{}_{}_{}_{}_{}'.format(
+        args["task"], list(filter(None, args["model_name_or_path"].split("/"))).pop(), args["max_seq_len"], mode,
+        key[:16])
+    return os.path.join(args["data_dir"], cached_file_name)
+
+
+class FeatureStoreWriter(object):
+    """
+    Writes a columnar feature store chunk by chunk: one flat `<name>.bin` file per column plus
+    `header.json` with dtypes and shapes. Chunks are appended to the column files as they come, so
+    memory is bounded by the chunk size rather than the corpus. The store is assembled in a temporary
+    directory next to the target and renamed into place by `close`, so readers never see a partial store.
+    Args:
+        cached_features_dir: Final location of the store.
+    """
+
+    def __init__(self, cached_features_dir):
+        self.cached_features_dir = cached_features_dir
+        parent_dir = os.path.dirname(cached_features_dir) or "."
+        self.tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(cached_features_dir) + ".", suffix=".tmp",
+                                        dir=parent_dir)
+        self.columns = {}
+        self.num_examples = 0
+        self.num_tokens = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _append_column(self, name, array):
+        array = np.ascontiguousarray(array)
+        column = self.columns.get(name)
+        if column is None:
+            column = self.columns[name] = {"dtype": array.dtype.str, "shape": [0] + list(array.shape[1:])}
+        elif column["dtype"] != array.dtype.str or column["shape"][1:] != list(array.shape[1:]):
+            raise ValueError("Chunk column {} does not match the previous chunks".format(name))
+        with open(os.path.join(self.tmp_dir, name + ".bin"), "ab") as f:
+            array.tofile(f)
+        column["shape"][0] += array.shape[0]
+
+    def append(self, features):
+        """
+        Appends one chunk of features, as returned by `convert_examples_to_features`.
+        The chunk's `offsets` start at 0 and are shifted past the tokens already written.
+        """
+        offsets = np.asarray(features["offsets"], dtype=np.int64)
+        if self.num_examples == 0:
+            self._append_column("offsets", offsets[:1])
+        self._append_column("offsets", offsets[1:] + self.num_tokens)
+        for name, array in features.items():
+            if name != "offsets":
+                self._append_column(name, array)
+        self.num_examples += len(offsets) - 1
+        self.num_tokens += int(offsets[-1])
+
+    def close(self):
+        try:
+            if "offsets" not in self.columns:
+                self._append_column("offsets", np.zeros(1, dtype=np.int64))
+            header = {"version": FEATURE_CACHE_VERSION, "columns": self.columns}
+            with open(os.path.join(self.tmp_dir, "header.json"), "w", encoding="utf-8") as f:
+                json.dump(header, f, indent=2)
+            try:
+                os.rename(self.tmp_dir, self.cached_features_dir)
+            except OSError:
+                if not os.path.isdir(self.cached_features_dir):
+                    raise
+                # Another job stored the same features first
+                logger.info("Feature store %s was written concurrently, keeping the existing one",
+                            self.cached_features_dir)
+                shutil.rmtree(self.tmp_dir)
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self):
+        if os.path.isdir(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+
+
+def save_features(features, cached_features_dir):
+    """Writes the features of a whole split as a feature store in one chunk (see `FeatureStoreWriter`)."""
+    with FeatureStoreWriter(cached_features_dir) as writer:
+        writer.append(features)
+
+
+def load_features(cached_features_dir):
+    """
+    Opens a feature store written by `FeatureStoreWriter` or `save_features`.
+    Returns:
+        dict of copy-on-write `np.memmap` arrays, so the pages are shared by every process reading the store.
+    """
+    with open(os.path.join(cached_features_dir, "header.json"), "r", encoding="utf-8") as f:
+        header = json.load(f)
+    features = {}
+    for name, column in header["columns"].items():
+        dtype, shape = np.dtype(column["dtype"]), tuple(column["shape"])
+        if int(np.prod(shape)) == 0:
+            features[name] = np.zeros(shape, dtype=dtype)  # np.memmap cannot map an empty file
+        else:
+            features[name] = np.memmap(os.path.join(cached_features_dir, name + ".bin"), dtype=dtype, mode="c", shape=shape)
+    return features
@@ -0,0 +1,71 @@
+import os
+import logging
+import multiprocessing
+from collections import deque
+
+from token_cache import get_token_cache
+from feature_cache import iter_chunks
+
+logger = logging.getLogger(__name__)
+
+# State of a featurization worker process, set once by `_init_worker`
+_worker = {}
+
+
+def _init_worker(convert_fn, tokenizer, max_seq_len, token_cache_size, warm_token_cache, convert_kwargs):
+    # The tokenizer is unpickled (or inherited on fork) once per worker, not once per chunk
+    _worker["convert_fn"] = convert_fn
+    _worker["tokenizer"] = tokenizer
+    _worker["max_seq_len"] = max_seq_len
+    _worker["token_cache"] = get_token_cache(tokenizer, max_size=token_cache_size, warm=warm_token_cache)
+    _worker["convert_kwargs"] = convert_kwargs
+
+
+def _convert_chunk(start_index, examples):
+    return _worker["convert_fn"](examples, _worker["max_seq_len"], _worker["tokenizer"],
+                                 token_cache=_worker["token_cache"], start_index=start_index,
+                                 **_worker["convert_kwargs"])
+
+
+def get_num_workers(num_workers):
+    """0 means one worker per CPU core."""
+    return num_workers if num_workers > 0 else (os.cpu_count() or 1)
+
+
+def featurize_to_store(examples, writer, convert_fn, tokenizer, max_seq_len, chunk_size,
+                       num_workers=1, token_cache_size=65536, warm_token_cache=False, **convert_kwargs):
+    """
+    Converts a stream of examples chunk by chunk with `convert_fn` and appends the chunks to `writer`
+    in their original order, so the store is byte-identical whatever the number of workers.
+    Args:
+        examples: Iterable of examples, consumed lazily.
+        writer: `feature_cache.FeatureStoreWriter` of the split.
+        convert_fn: Module-level `convert_examples_to_features` of the task's loader.
+        chunk_size: Number of examples per chunk (and per task sent to a worker).
+        num_workers: Number of featurization processes; 1 converts in this process, 0 uses every core.
+        convert_kwargs: Extra arguments of `convert_fn` (pad_token_label_id, ...).
+    """
+    num_workers = get_num_workers(num_workers)
+    chunks = iter_chunks(examples, chunk_size)
+
+    if num_workers == 1:
+        token_cache = get_token_cache(tokenizer, max_size=token_cache_size, warm=warm_token_cache)
+        for chunk_index, chunk in enumerate(chunks):
+            writer.append(convert_fn(chunk, max_seq_len, tokenizer, token_cache=token_cache,
+                                     start_index=chunk_index * chunk_size, **convert_kwargs))
+        token_cache.log_stats()
+        return
+
+    logger.info("Featurizing with %d worker processes", num_workers)
+    with multiprocessing.Pool(num_workers, initializer=_init_worker,
+                              initargs=(convert_fn, tokenizer, max_seq_len, token_cache_size, warm_token_cache,
+                                        convert_kwargs)) as pool:
+        # Keep a bounded window of chunks in flight and write them back in submission order,
+        # so memory stays bounded by a few chunks per worker
+        pending = deque()
+        for chunk_index, chunk in enumerate(chunks):
+            pending.append(pool.apply_async(_convert_chunk, (chunk_index * chunk_size, chunk)))
+            if len(pending) >= 2 * num_workers:
+                writer.append(pending.popleft().get())
+        while pending:
+            writer.append(pending.popleft().get())
@@ -0,0 +1,249 @@
+import os
+import sys
+import copy
+import time
+import logging
+
+import numpy as np
+import torch
+
+from batching import FeatureDataset, LengthBucketSampler
+from feature_cache import iter_chunks
+from mixed_precision import MixedPrecision
+from utils import init_logger, load_tokenizer, MODEL_CLASSES
+
+logger = logging.getLogger(__name__)
+
+TLINK_MARKERS = ['[B1]', '[E1]', '[B2]', '[E2]']
+
+
+class Predictor(object):
+    """
+    Tags raw, unlabeled sentences with a trained model_dir (event/timex3 NER, TLINK or multi-task), loaded once.
+    NER sentences are tagged character by character, as in the training files; TLINK sentences are
+    whitespace-separated words with the [B1] [E1] [B2] [E2] markers around the two entities, and get one
+    relation each. Sentences are converted like the training data, sorted by length within chunks of
+    `chunk_size`, padded per batch and run under torch.inference_mode; the results come out in input order.
+    A multi-task model_dir (MultiTaskTrainer.save_model) runs the heads given by `heads`: by default all its
+    token-classification heads (event and timex3) on one encoder pass, each prediction then being a dict of
+    head name to tags. `with_heads` gives a predictor for other heads of the same loaded model (e.g. tlink).
+    Args:
+        model_dir: Directory written by Trainer.save_model (weights, config and training_args.bin).
+        batch_size: Sentences per forward pass.
+        chunk_size: Sentences read ahead and sorted by length (a multiple of batch_size).
+        mixed_precision: "no", "bf16" or "fp16" autocast.
+        no_cuda: Run on CPU even if a GPU is available.
+        heads: Heads of a multi-task model to run; a sequence head (tlink) only runs alone.
+    """
+
+    def __init__(self, model_dir, batch_size=64, chunk_size=4096, mixed_precision="no", no_cuda=False, heads=None):
+        # Keys (task, model type, max_seq_len, tokenizer path) of the training run
+        self.args = torch.load(os.path.join(model_dir, "training_args.bin"), weights_only=False)
+        self.task = self.args["task"]
+        self.is_multitask = self.task == "multitask"
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+
+        self.tokenizer = load_tokenizer(self.args)
+        if self.is_multitask or self.task == "tlink-re":
+            # The multi-task embeddings were resized to the markers for all the heads
+            self.tokenizer.add_special_tokens({'additional_special_tokens': TLINK_MARKERS})
+
+        self.device = "cuda" if torch.cuda.is_available() and not no_cuda else "cpu"
+        if self.is_multitask:
+            from modeling_multitask import MultiTaskModel
+            self.model = MultiTaskModel.from_pretrained(model_dir, MODEL_CLASSES[self.args["model_type"]][1])
+            self.id2labels = {task: np.array(labels, dtype=object) for task, labels in self.model.task_labels.items()}
+        else:
+            self.model = MODEL_CLASSES[self.args["model_type"]][1].from_pretrained(model_dir)
+            config = self.model.config
+            self.id2labels = {None: np.array([config.id2label[i] for i in range(config.num_labels)], dtype=object)}
+        self.model.to(self.device)
+        self.model.eval()
+        self.precision = MixedPrecision(mixed_precision, self.device)
+        self.pad_token_label_id = torch.nn.CrossEntropyLoss().ignore_index
+        self._select_heads(heads)
+        logger.info("Loaded %s model %s on %s", self.task, model_dir, self.device)
+
+    def _select_heads(self, heads):
+        if not self.is_multitask:
+            if heads is not None:
+                raise ValueError("heads only apply to a multi-task model_dir, not to a {} one".format(self.task))
+            self.heads = [None]
+            self.is_tlink = self.task == "tlink-re"
+        else:
+            sequence_tasks = self.model.sequence_tasks
+            if heads is None:
+                heads = [task for task in self.model.task_labels if task not in sequence_tasks]
+            self.heads = list(heads)
+            unknown = [head for head in self.heads if head not in self.model.task_labels]
+            if not self.heads or unknown:
+                raise ValueError("Invalid heads {}, the model has {}".format(self.heads, list(self.model.task_labels)))
+            self.is_tlink = any(head in sequence_tasks for head in self.heads)
+            if self.is_tlink and len(self.heads) > 1:
+                raise ValueError("A sequence head runs alone, not with other heads: {}".format(self.heads))
+        # The labels of the only head (None when several heads run)
+        self.id2label = self.id2labels[self.heads[0]] if len(self.heads) == 1 else None
+
+        if self.is_tlink:
+            from data_loader_tlink import InputExample, convert_examples_to_features
+        else:
+            from data_loader import InputExample, convert_examples_to_features
+        self._input_example = InputExample
+        self._convert_examples_to_features = convert_examples_to_features
+
+    def with_heads(self, heads):
+        """A predictor running other heads of this multi-task model; the model and the tokenizer are shared."""
+        if not self.is_multitask:
+            raise ValueError("heads only apply to a multi-task model_dir, not to a {} one".format(self.task))
+        predictor = copy.copy(self)
+        predictor._select_heads(heads)
+        return predictor
+
+    def _to_example(self, index, sentence):
+        if self.is_tlink:
+            words = sentence.split()
+            if "[B1]" not in words or "[B2]" not in words:
+                raise ValueError("TLINK sentence {} has no [B1]/[B2] entity markers: {}".format(index, sentence))
+            return self._input_example(guid="infer-{}".format(index), words=words, label=0)
+        # A dummy label on every character marks the first token of each word in the features
+        words = list(sentence)
+        return self._input_example(guid="infer-{}".format(index), words=words, labels=[0] * len(words))
+
+    def featurize(self, sentences, start_index=0):
+        """
+        Converts sentences into a FeatureDataset (the tokenizer side of `predict_batch`).
+        Args:
+            sentences: List of raw sentences.
+            start_index: Index of the first sentence in the whole input (for error messages).
+        Returns:
+            (examples, dataset)
+        """
+        examples = [self._to_example(start_index + i, sentence) for i, sentence in enumerate(sentences)]
+        # Raises ValueError (with the infer-<index> guid) when max_seq_len cuts off a TLINK entity marker
+        features = self._convert_examples_to_features(examples, self.args["max_seq_len"], self.tokenizer,
+                                                      pad_token_label_id=self.pad_token_label_id,
+                                                      start_index=start_index)
+        dataset = FeatureDataset(features, self.tokenizer.pad_token_id, pad_token_label_id=self.pad_token_label_id,
+                                 token_level_labels=not self.is_tlink)
+        return examples, dataset
+
+    def forward(self, examples, dataset):
+        """Runs the model over a featurized input (the model side of `predict_batch`); returns the predictions."""
+        results = [None] * len(examples)
+        for batch_index in LengthBucketSampler(dataset.lengths, self.batch_size, shuffle=False).batches():
+            batch = dataset.collate([dataset[i] for i in batch_index])
+            inputs = {'input_ids': batch[0].to(self.device),
+                      'attention_mask': batch[1].to(self.device)}
+            if self.args["model_type"] != 'distilkobert':
+                inputs['token_type_ids'] = batch[2].to(self.device)
+            if getattr(self.model, "uses_entity_starts", False):
+                inputs['entity_starts'] = batch[4].to(self.device)
+            with torch.inference_mode(), self.precision.autocast():
+                head_logits = self._logits(inputs)
+            head_preds = {head: logits.argmax(dim=-1).cpu().numpy() for head, logits in head_logits.items()}
+
+            if self.is_tlink:
+                preds = head_preds[self.heads[0]]
+                for i, pred in zip(batch_index, preds):
+                    results[i] = self.id2label[pred]
+                continue
+            # One tag per character from its first token; characters cut off by max_seq_len are "O"
+            word_starts = batch[3].numpy() != self.pad_token_label_id
+            for row, (i, mask) in enumerate(zip(batch_index, word_starts)):
+                tags = {}
+                for head, preds in head_preds.items():
+                    head_tags = self.id2labels[head][preds[row][mask]].tolist()
+                    tags[head] = head_tags + ["O"] * (len(examples[i].words) - len(head_tags))
+                results[i] = tags if len(self.heads) > 1 else tags[self.heads[0]]
+        return results
+
+    def _logits(self, inputs):
+        """Returns a dict of head name (None for a single-task model) to logits."""
+        if not self.is_multitask:
+            return {None: self.model(**inputs)[0]}
+        if self.is_tlink:
+            return {self.heads[0]: self.model(self.heads[0], **inputs)[0]}
+        # All the token-classification heads share one encoder pass
+        return self.model.tag(tasks=self.heads, **inputs)
+
+    def predict_batch(self, sentences, start_index=0):
+        """
+        Args:
+            sentences: List of raw sentences, converted and run together.
+            start_index: Index of the first sentence in the whole input (for error messages).
+        Returns:
+            List of the predictions, as in `predict`
+        """
+        return self.forward(*self.featurize(sentences, start_index))
+
+    def predict(self, sentences):
+        """
+        Args:
+            sentences: Iterable of raw sentences (str), consumed lazily.
+        Returns:
+            Generator of the predictions in input order: a list of tags (one per character) for NER,
+            a relation label for TLINK, a dict of head name to tags for several multi-task heads
+        """
+        start_index = 0
+        for chunk in iter_chunks(sentences, self.chunk_size):
+            yield from self.predict_batch(chunk, start_index)
+            start_index += len(chunk)
+
+
+def format_prediction(sentence, prediction):
+    """
+    Formats a prediction like the training files: the sentence, a tab, and the tags (or the relation);
+    several heads give one tab-separated column of tags each.
+    """
+    if isinstance(prediction, dict):
+        return "\t".join([sentence] + [" ".join(tags) for tags in prediction.values()])
+    if isinstance(prediction, list):
+        prediction = " ".join(prediction)
+    return "{}\t{}".format(sentence, prediction)
+
+
+def run(predictor, input_lines, output):
+    """Streams `input_lines` through the predictor into the `output` file object; returns the number of sentences."""
+    sentences = (line.rstrip("\n") for line in input_lines)
+    # The sentences are needed twice (predict and output), so keep each chunk around until it is written
+    num_sentences = 0
+    for chunk in iter_chunks(sentences, predictor.chunk_size):
+        for sentence, prediction in zip(chunk, predictor.predict_batch(chunk, num_sentences)):
+            output.write(format_prediction(sentence, prediction) + "\n")
+        num_sentences += len(chunk)
+    return num_sentences
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage:  $ python3 inference.py model_dir [input_file|-] [output_file] [--heads=event,timex3]")
+        print("  Tags one raw sentence per line (stdin by default) and writes sentence<TAB>prediction lines")
+        print("  --heads: Heads of a multi-task model_dir to run (default: all its token-classification heads)")
+        exit()
+    init_logger()
+    heads = None
+    positional = []
+    for arg in sys.argv[1:]:
+        if arg.startswith("--heads="):
+            heads = arg[len("--heads="):].split(",")
+        else:
+            positional.append(arg)
+    model_dir = positional[0]
+    input_file = positional[1] if len(positional) > 1 else "-"
+    output_file = positional[2] if len(positional) > 2 else None
+
+    predictor = Predictor(model_dir, heads=heads)
+    start = time.time()
+    input_lines = sys.stdin if input_file == "-" else open(input_file, "r", encoding="utf-8")
+    output = open(output_file, "w", encoding="utf-8") if output_file else sys.stdout
+    try:
+        num_sentences = run(predictor, input_lines, output)
+    finally:
+        if input_lines is not sys.stdin:
+            input_lines.close()
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.time() - start
+    logger.info("Tagged %d sentences in %.1fs (%.1f sentences/sec)", num_sentences, elapsed,
+                num_sentences / elapsed if elapsed > 0 else 0.0)
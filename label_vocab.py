@@ -0,0 +1,105 @@
+import os
+import logging
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+UNK_LABEL = "UNK"
+
+
+class LabelVocab(object):
+    """
+    Immutable label <-> id mapping, shared by the processors, the trainers and the metrics.
+    Labels that are not in the vocab map to the id of `unk_label`, and can be counted with `UnknownLabelCounter`.
+    Args:
+        labels: Label strings in label id order.
+        unk_label: Label that unknown labels are collapsed into.
+    """
+
+    def __init__(self, labels, unk_label=UNK_LABEL):
+        self._labels = tuple(labels)
+        self._label2id = {}
+        for i, label in enumerate(self._labels):
+            self._label2id.setdefault(label, i)  # The first occurrence wins, like list.index
+        self.unk_label = unk_label
+        self.unk_id = self._label2id.get(unk_label)
+
+    @classmethod
+    def from_file(cls, label_file, unk_label=UNK_LABEL):
+        with open(label_file, "r", encoding="utf-8") as f:
+            return cls([label.strip() for label in f], unk_label=unk_label)
+
+    @property
+    def labels(self):
+        return self._labels
+
+    def __len__(self):
+        return len(self._labels)
+
+    def __iter__(self):
+        return iter(self._labels)
+
+    def __getitem__(self, label_id):
+        return self._labels[label_id]
+
+    def __contains__(self, label):
+        return label in self._label2id
+
+    def __setattr__(self, name, value):
+        if "unk_id" in self.__dict__:
+            raise AttributeError("LabelVocab is immutable")
+        super().__setattr__(name, value)
+
+    def label_to_id(self, label, unk_counter=None):
+        """
+        Returns the id of `label`, or the UNK id if it is not in the vocab.
+        Args:
+            unk_counter: Optional `UnknownLabelCounter` that records the label when it is unknown.
+        """
+        label_id = self._label2id.get(label)
+        if label_id is not None:
+            return label_id
+        if self.unk_id is None:
+            raise ValueError("Unknown label {!r} and no {!r} label to map it to".format(label, self.unk_label))
+        if unk_counter is not None:
+            unk_counter.add(label)
+        return self.unk_id
+
+    def id2label(self):
+        """id -> label dict, as expected by the transformers configs."""
+        return {str(i): label for i, label in enumerate(self._labels)}
+
+    def label2id(self):
+        return {label: i for i, label in enumerate(self._labels)}
+
+
+class UnknownLabelCounter(object):
+    """Counts the labels that were collapsed into UNK while reading a data file."""
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def add(self, label):
+        self.counts[label] += 1
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def log(self, source):
+        if not self.counts:
+            return
+        logger.warning("%d labels of %s are not in the label vocab and were mapped to UNK: %s",
+                       self.total(), source, ", ".join("{} ({})".format(label, count)
+                                                       for label, count in self.counts.most_common()))
+
+
+_label_vocabs = {}
+
+
+def get_label_vocab(args):
+    """Returns the process-wide LabelVocab of `args["label_file"]`, reading the file only once."""
+    label_file = os.path.abspath(os.path.join(args["data_dir"], args["label_file"]))
+    vocab = _label_vocabs.get(label_file)
+    if vocab is None:
+        vocab = _label_vocabs[label_file] = LabelVocab.from_file(label_file)
+    return vocab
@@ -0,0 +1,237 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Tag codes of the chunking rules (seqeval's conlleval-compatible default mode)
+TAG_O, TAG_B, TAG_I, TAG_E, TAG_S, TAG_DOT, TAG_OTHER = range(7)
+TAG_CODES = {"O": TAG_O, "B": TAG_B, "I": TAG_I, "E": TAG_E, "S": TAG_S, ".": TAG_DOT}
+
+
+class SpanScores(object):
+    """Per-class entity counts, from which the micro scores and the per-class report are derived."""
+
+    def __init__(self, type_names, tp_sum, pred_sum, true_sum):
+        self.type_names = type_names
+        self.tp_sum = tp_sum
+        self.pred_sum = pred_sum
+        self.true_sum = true_sum
+
+    @staticmethod
+    def _prf(tp_sum, pred_sum, true_sum):
+        # Zero divisions give 0, like seqeval's zero_division='warn'
+        precision = tp_sum / np.where(pred_sum == 0, 1, pred_sum)
+        recall = tp_sum / np.where(true_sum == 0, 1, true_sum)
+        denom = precision + recall
+        f1 = 2 * precision * recall / np.where(denom == 0, 1, denom)
+        return precision, recall, f1
+
+    def average(self, average="micro"):
+        """
+        Args:
+            average: micro, macro or weighted
+        Returns:
+            (precision, recall, f1, support)
+        """
+        if average == "micro":
+            precision, recall, f1 = self._prf(self.tp_sum.sum(keepdims=True), self.pred_sum.sum(keepdims=True),
+                                              self.true_sum.sum(keepdims=True))
+            return float(precision[0]), float(recall[0]), float(f1[0]), int(self.true_sum.sum())
+
+        precision, recall, f1 = self._prf(self.tp_sum, self.pred_sum, self.true_sum)
+        weights = None
+        if average == "weighted":
+            weights = self.true_sum
+            if weights.sum() == 0:
+                return 0.0, 0.0, 0.0, 0
+        elif average != "macro":
+            raise ValueError("average has to be one of ('micro', 'macro', 'weighted')")
+        if len(self.type_names) == 0:
+            return 0.0, 0.0, 0.0, 0
+        return (float(np.average(precision, weights=weights)), float(np.average(recall, weights=weights)),
+                float(np.average(f1, weights=weights)), int(self.true_sum.sum()))
+
+    def summary(self):
+        precision, recall, f1, _ = self.average("micro")
+        return {
+            "precision": precision,
+            "recall": recall,
+            "f1": f1
+        }
+
+    def report(self, digits=2):
+        """Per-class report, formatted like `seqeval.metrics.classification_report`."""
+        width = max([len(name) for name in self.type_names] + [len("weighted avg"), digits])
+        row_fmt = "{:>{width}s} " + " {:>9.{digits}f}" * 3 + " {:>9}"
+        headers = ["precision", "recall", "f1-score", "support"]
+        report = ("{:>{width}s} " + " {:>9}" * len(headers)).format("", *headers, width=width) + "\n\n"
+
+        rows = []
+        precision, recall, f1 = self._prf(self.tp_sum, self.pred_sum, self.true_sum)
+        for row in zip(self.type_names, precision, recall, f1, self.true_sum):
+            rows.append(row_fmt.format(*row, width=width, digits=digits))
+        rows.append("")
+        for average in ("micro", "macro", "weighted"):
+            rows.append(row_fmt.format("{} avg".format(average), *self.average(average), width=width, digits=digits))
+        rows.append("")
+        return report + "\n".join(rows)
+
+
+class SpanMetric(object):
+    """
+    Entity-level precision/recall/F1 over label id arrays, equivalent to seqeval's default
+    (conlleval-compatible) `precision_score`/`recall_score`/`f1_score`/`classification_report`.
+    Entities are extracted for all sentences at once with vectorized chunk start/end rules.
+    Args:
+        label_lst: Label strings in label id order (a list or a `label_vocab.LabelVocab`).
+        suffix: Tags are suffixes (`EVENT-B`) rather than prefixes (`B-EVENT`).
+    """
+
+    def __init__(self, label_lst, suffix=True):
+        self.label_lst = label_lst
+        self.suffix = suffix
+
+        self.type_names = ["_"]  # The type of "O"; also used for the sentence separators
+        type_ids = {"_": 0}
+        tags, types = [], []
+        for label in label_lst:
+            if suffix:
+                tag, type_name = label[-1:], label[:-1].rsplit("-", maxsplit=1)[0] or "_"
+            else:
+                tag, type_name = label[:1], label[1:].split("-", maxsplit=1)[-1] or "_"
+            if type_name not in type_ids:
+                type_ids[type_name] = len(self.type_names)
+                self.type_names.append(type_name)
+            tags.append(TAG_CODES.get(tag, TAG_OTHER))
+            types.append(type_ids[type_name])
+        self.tags = np.array(tags, dtype=np.int8)
+        self.types = np.array(types, dtype=np.int64)
+
+    def get_entities(self, label_ids, lengths):
+        """
+        Args:
+            label_ids: Flat label ids of all sentences, back to back.
+            lengths: Number of labels of each sentence.
+        Returns:
+            (types, begins, ends) arrays. Positions count one "O" separator after each sentence, as seqeval does.
+        """
+        label_ids = np.asarray(label_ids, dtype=np.int64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        num_positions = len(label_ids) + len(lengths) + 1
+
+        # Insert an "O" after every sentence, and one more at the end
+        tag = np.full(num_positions, TAG_O, dtype=np.int8)
+        typ = np.zeros(num_positions, dtype=np.int64)
+        positions = np.arange(len(label_ids)) + np.repeat(np.arange(len(lengths)), lengths)
+        tag[positions] = self.tags[label_ids]
+        typ[positions] = self.types[label_ids]
+
+        prev_tag = np.concatenate([[TAG_O], tag[:-1]])
+        prev_typ = np.concatenate([[-1], typ[:-1]])
+        type_changed = prev_typ != typ
+
+        prev_b_or_i = (prev_tag == TAG_B) | (prev_tag == TAG_I)
+        tag_b_s_o = (tag == TAG_B) | (tag == TAG_S) | (tag == TAG_O)
+        chunk_end = ((prev_tag == TAG_E) | (prev_tag == TAG_S) | (prev_b_or_i & tag_b_s_o)
+                     | ((prev_tag != TAG_O) & (prev_tag != TAG_DOT) & type_changed))
+
+        prev_e_s_o = (prev_tag == TAG_E) | (prev_tag == TAG_S) | (prev_tag == TAG_O)
+        tag_e_or_i = (tag == TAG_E) | (tag == TAG_I)
+        chunk_start = ((tag == TAG_B) | (tag == TAG_S) | (prev_e_s_o & tag_e_or_i)
+                       | ((tag != TAG_O) & (tag != TAG_DOT) & type_changed))
+
+        # A chunk ending at i spans from the last chunk start before i to i - 1
+        last_start = np.maximum.accumulate(np.where(chunk_start, np.arange(num_positions), 0))
+        end_positions = np.flatnonzero(chunk_end)
+        return prev_typ[end_positions], last_start[end_positions - 1], end_positions - 1
+
+    def score(self, true_ids, pred_ids, lengths):
+        """
+        Args:
+            true_ids: Flat gold label ids of all sentences (padding already removed).
+            pred_ids: Flat predicted label ids, aligned with true_ids.
+            lengths: Number of labels of each sentence.
+        Returns:
+            SpanScores
+        """
+        true_types, true_begins, true_ends = self.get_entities(true_ids, lengths)
+        pred_types, pred_begins, pred_ends = self.get_entities(pred_ids, lengths)
+
+        # At most one entity ends at any position, so entities match iff they share the end, begin and type
+        _, true_index, pred_index = np.intersect1d(true_ends, pred_ends, assume_unique=True, return_indices=True)
+        matched = ((true_begins[true_index] == pred_begins[pred_index])
+                   & (true_types[true_index] == pred_types[pred_index]))
+
+        num_types = len(self.type_names)
+        tp_sum = np.bincount(true_types[true_index][matched], minlength=num_types)
+        pred_sum = np.bincount(pred_types, minlength=num_types)
+        true_sum = np.bincount(true_types, minlength=num_types)
+
+        present = [i for i in range(num_types) if pred_sum[i] or true_sum[i]]
+        present.sort(key=lambda i: self.type_names[i])
+        return SpanScores([self.type_names[i] for i in present], tp_sum[present], pred_sum[present], true_sum[present])
+
+
+class ConfusionMatrix(object):
+    """
+    Confusion matrix of single-label classification (TLINK), built with one bincount. Precision, recall
+    and F1 follow `sklearn.metrics.precision_recall_fscore_support` over the classes present in either
+    the gold labels or the predictions, with zero divisions giving 0.
+    Args:
+        labels: Gold label ids.
+        preds: Predicted label ids.
+        num_labels: Number of classes.
+    """
+
+    def __init__(self, labels, preds, num_labels):
+        labels = np.asarray(labels, dtype=np.int64)
+        preds = np.asarray(preds, dtype=np.int64)
+        assert len(labels) == len(preds)
+        self.num_labels = num_labels
+        self.matrix = np.bincount(labels * num_labels + preds, minlength=num_labels * num_labels).reshape(num_labels, num_labels)
+
+    def scores(self, average="micro"):
+        """
+        Args:
+            average: micro, macro or weighted
+        Returns:
+            (precision, recall, f1)
+        """
+        tp_sum = np.diag(self.matrix)
+        true_sum = self.matrix.sum(axis=1)
+        pred_sum = self.matrix.sum(axis=0)
+        present = (true_sum + pred_sum) > 0
+        tp_sum, true_sum, pred_sum = tp_sum[present], true_sum[present], pred_sum[present]
+
+        if average == "micro":
+            tp_sum, true_sum, pred_sum = tp_sum.sum(keepdims=True), true_sum.sum(keepdims=True), pred_sum.sum(keepdims=True)
+        elif average not in ("macro", "weighted"):
+            raise ValueError("average has to be one of ('micro', 'macro', 'weighted')")
+        if len(tp_sum) == 0:
+            return 0.0, 0.0, 0.0
+
+        precision = tp_sum / np.where(pred_sum == 0, 1, pred_sum)
+        recall = tp_sum / np.where(true_sum == 0, 1, true_sum)
+        denom = 2 * tp_sum + (pred_sum - tp_sum) + (true_sum - tp_sum)
+        f1 = 2 * tp_sum / np.where(denom == 0, 1, denom)
+
+        weights = true_sum if average == "weighted" else None
+        if weights is not None and weights.sum() == 0:
+            return 0.0, 0.0, 0.0
+        return (float(np.average(precision, weights=weights)), float(np.average(recall, weights=weights)),
+                float(np.average(f1, weights=weights)))
+
+    def summary(self):
+        results = {}
+        for average in ("micro", "macro", "weighted"):
+            precision, recall, f1 = self.scores(average)
+            results["({})precision".format(average)] = precision
+            results["({})recall".format(average)] = recall
+            results["({})f1".format(average)] = f1
+        return results
+
+    def to_frame(self, class_names):
+        """The confusion matrix as a DataFrame with gold labels as rows and predictions as columns."""
+        import pandas as pd
+        return pd.DataFrame(self.matrix, index=class_names, columns=class_names)
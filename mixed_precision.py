@@ -0,0 +1,66 @@
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+PRECISION_DTYPES = {
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
+
+
+class MixedPrecision(object):
+    """
+    Opt-in autocast for the trainers. The weights, the optimizer and the checkpoints stay fp32;
+    only the forward pass (and so the activations and their gradients) runs in reduced precision.
+    fp16 uses a GradScaler against gradient underflow; bf16 has the fp32 exponent range and needs none.
+    Args:
+        mode: "no", "bf16" or "fp16" (args["mixed_precision"]).
+        device: "cpu" or "cuda".
+    """
+
+    def __init__(self, mode, device):
+        if mode not in ("no", "bf16", "fp16"):
+            raise ValueError("mixed_precision has to be one of ('no', 'bf16', 'fp16')")
+        if mode == "fp16" and device == "cpu":
+            logger.warning("fp16 autocast is not supported for CPU training, using bf16 instead")
+            mode = "bf16"
+        if mode == "bf16" and device == "cuda" and not torch.cuda.is_bf16_supported():
+            logger.warning("This GPU does not support bf16, using fp16 instead")
+            mode = "fp16"
+
+        self.mode = mode
+        self.device = device
+        self.enabled = mode != "no"
+        self.dtype = PRECISION_DTYPES.get(mode, torch.float32)
+        self.scaler = torch.cuda.amp.GradScaler() if mode == "fp16" else None
+        if self.enabled:
+            logger.info("Mixed precision: %s autocast on %s%s", mode, device, " with loss scaling" if self.scaler else "")
+
+    def autocast(self):
+        return torch.autocast(device_type=self.device, dtype=self.dtype, enabled=self.enabled)
+
+    def backward(self, loss):
+        if self.scaler is not None:
+            loss = self.scaler.scale(loss)
+        loss.backward()
+
+    def step(self, optimizer, parameters, max_grad_norm):
+        """Clips the (unscaled) gradients to max_grad_norm and takes an optimizer step."""
+        if self.scaler is not None:
+            self.scaler.unscale_(optimizer)
+        torch.nn.utils.clip_grad_norm_(parameters, max_grad_norm)
+        if self.scaler is not None:
+            # Skips the step if the gradients overflowed, and adjusts the scale
+            self.scaler.step(optimizer)
+            self.scaler.update()
+        else:
+            optimizer.step()
+
+    def state_dict(self):
+        return self.scaler.state_dict() if self.scaler is not None else {}
+
+    def load_state_dict(self, state_dict):
+        if self.scaler is not None and state_dict:
+            self.scaler.load_state_dict(state_dict)
@@ -0,0 +1,111 @@
+import os
+import json
+import logging
+
+import torch
+from torch import nn
+
+logger = logging.getLogger(__name__)
+
+MULTITASK_CONFIG_NAME = "multitask_config.json"
+MULTITASK_HEADS_NAME = "multitask_heads.bin"
+
+
+class MultiTaskModel(nn.Module):
+    """
+    One shared encoder (BertModel/ElectraModel) with a head per task: a token-classification head for
+    each NER task (event, timex3) and a sequence-classification head for TLINK, which classifies the
+    [CLS] state through a tanh pooler like BertForSequenceClassification. One encoder pass feeds all the
+    token-classification heads of a sentence (`tag`).
+    The encoder is saved with `save_pretrained` (config.json, pytorch_model.bin) and the heads next to it.
+    Args:
+        encoder: transformers base model.
+        task_labels: dict of task name to its label list.
+        sequence_tasks: Tasks classified per sequence; the others are classified per token.
+    """
+
+    def __init__(self, encoder, task_labels, sequence_tasks=("tlink",)):
+        super(MultiTaskModel, self).__init__()
+        self.encoder = encoder
+        self.config = encoder.config
+        self.task_labels = {task: list(labels) for task, labels in task_labels.items()}
+        self.sequence_tasks = tuple(sequence_tasks)
+
+        hidden_size = self.config.hidden_size
+        self.dropout = nn.Dropout(self.config.hidden_dropout_prob)
+        self.heads = nn.ModuleDict()
+        for task, labels in self.task_labels.items():
+            if task in self.sequence_tasks:
+                self.heads[task] = nn.Sequential(nn.Linear(hidden_size, hidden_size), nn.Tanh(),
+                                                 nn.Dropout(self.config.hidden_dropout_prob),
+                                                 nn.Linear(hidden_size, len(labels)))
+            else:
+                self.heads[task] = nn.Linear(hidden_size, len(labels))
+        self.heads.apply(self._init_weights)
+
+    def _init_weights(self, module):
+        # As the transformers heads are initialized
+        if isinstance(module, nn.Linear):
+            module.weight.data.normal_(mean=0.0, std=self.config.initializer_range)
+            module.bias.data.zero_()
+
+    def _logits(self, task, hidden_states):
+        if task in self.sequence_tasks:
+            return self.heads[task](hidden_states[:, 0])
+        return self.heads[task](self.dropout(hidden_states))
+
+    def forward(self, task, input_ids, attention_mask=None, token_type_ids=None, labels=None, class_weights=None):
+        """
+        Args:
+            task: Head to use.
+            labels: Label ids, [batch_size, seq_len] for token tasks (-100 is ignored) or [batch_size].
+            class_weights: Optional weight of every class in the loss.
+        Returns:
+            (loss, logits) with labels, else (logits,)
+        """
+        hidden_states = self.encoder(input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)[0]
+        logits = self._logits(task, hidden_states)
+        if labels is None:
+            return (logits,)
+        loss_fct = nn.CrossEntropyLoss(weight=class_weights)
+        loss = loss_fct(logits.view(-1, len(self.task_labels[task])), labels.view(-1))
+        return loss, logits
+
+    def tag(self, input_ids, attention_mask=None, token_type_ids=None, tasks=None):
+        """
+        Runs every token-classification head (or `tasks`) over one encoder pass.
+        Returns:
+            dict of task name to [batch_size, seq_len, num_labels] logits
+        """
+        if tasks is None:
+            tasks = [task for task in self.task_labels if task not in self.sequence_tasks]
+        hidden_states = self.encoder(input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)[0]
+        return {task: self._logits(task, hidden_states) for task in tasks}
+
+    def save_pretrained(self, save_directory, state_dict=None):
+        """
+        Args:
+            state_dict: State dict to save instead of the model's own (e.g. a CPU snapshot).
+        """
+        if state_dict is None:
+            state_dict = self.state_dict()
+        os.makedirs(save_directory, exist_ok=True)
+        encoder_state = {key[len("encoder."):]: value for key, value in state_dict.items() if key.startswith("encoder.")}
+        heads_state = {key[len("heads."):]: value for key, value in state_dict.items() if key.startswith("heads.")}
+        self.encoder.save_pretrained(save_directory, state_dict=encoder_state)
+        torch.save(heads_state, os.path.join(save_directory, MULTITASK_HEADS_NAME))
+        with open(os.path.join(save_directory, MULTITASK_CONFIG_NAME), "w", encoding="utf-8") as f:
+            json.dump({"task_labels": self.task_labels, "sequence_tasks": list(self.sequence_tasks)}, f,
+                      ensure_ascii=False, indent=2)
+
+    @classmethod
+    def from_pretrained(cls, model_dir, encoder_class):
+        """
+        Args:
+            encoder_class: transformers base model class of the encoder (e.g. BertModel).
+        """
+        with open(os.path.join(model_dir, MULTITASK_CONFIG_NAME), "r", encoding="utf-8") as f:
+            config = json.load(f)
+        model = cls(encoder_class.from_pretrained(model_dir), config["task_labels"], config["sequence_tasks"])
+        model.heads.load_state_dict(torch.load(os.path.join(model_dir, MULTITASK_HEADS_NAME), map_location="cpu"))
+        return model
@@ -0,0 +1,85 @@
+from torch import nn
+from transformers import BertModel, BertPreTrainedModel, ElectraModel, ElectraPreTrainedModel
+
+
+class EntityMarkerHead(nn.Module):
+    """
+    Relation head over the hidden states at the [B1] and [B2] entity markers (entity_starts). Both
+    states of the whole batch are taken with one gather, concatenated and classified.
+    """
+
+    def __init__(self, config):
+        super(EntityMarkerHead, self).__init__()
+        self.dense = nn.Linear(2 * config.hidden_size, config.hidden_size)
+        self.activation = nn.Tanh()
+        self.dropout = nn.Dropout(config.hidden_dropout_prob)
+        self.out_proj = nn.Linear(config.hidden_size, config.num_labels)
+
+    def forward(self, hidden_states, entity_starts):
+        """
+        Args:
+            hidden_states: [batch_size, seq_len, hidden_size]
+            entity_starts: [batch_size, 2] positions of [B1] and [B2]
+        Returns:
+            [batch_size, num_labels] logits
+        """
+        batch_size, _, hidden_size = hidden_states.shape
+        index = entity_starts.unsqueeze(-1).expand(batch_size, entity_starts.shape[1], hidden_size)
+        entity_states = hidden_states.gather(1, index).reshape(batch_size, -1)
+        x = self.dropout(entity_states)
+        x = self.activation(self.dense(x))
+        x = self.dropout(x)
+        return self.out_proj(x)
+
+
+def _classify(model, hidden_states, entity_starts, labels):
+    logits = model.classifier(hidden_states, entity_starts)
+    if labels is None:
+        return (logits,)
+    loss_fct = nn.CrossEntropyLoss()
+    loss = loss_fct(logits.view(-1, model.num_labels), labels.view(-1))
+    return loss, logits
+
+
+class BertForEntityMarkerClassification(BertPreTrainedModel):
+    """BERT TLINK classifier from the entity marker states instead of the pooled [CLS]."""
+
+    # Tells the trainer and the predictor to pass batch[4]
+    uses_entity_starts = True
+
+    def __init__(self, config):
+        super(BertForEntityMarkerClassification, self).__init__(config)
+        self.num_labels = config.num_labels
+        self.bert = BertModel(config, add_pooling_layer=False)
+        self.classifier = EntityMarkerHead(config)
+        self.post_init()
+
+    def forward(self, input_ids, attention_mask=None, token_type_ids=None, entity_starts=None, labels=None):
+        """
+        Returns:
+            (loss, logits) with labels, else (logits,)
+        """
+        hidden_states = self.bert(input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)[0]
+        return _classify(self, hidden_states, entity_starts, labels)
+
+
+class ElectraForEntityMarkerClassification(ElectraPreTrainedModel):
+    """ELECTRA TLINK classifier from the entity marker states instead of the [CLS] state."""
+
+    # Tells the trainer and the predictor to pass batch[4]
+    uses_entity_starts = True
+
+    def __init__(self, config):
+        super(ElectraForEntityMarkerClassification, self).__init__(config)
+        self.num_labels = config.num_labels
+        self.electra = ElectraModel(config)
+        self.classifier = EntityMarkerHead(config)
+        self.post_init()
+
+    def forward(self, input_ids, attention_mask=None, token_type_ids=None, entity_starts=None, labels=None):
+        """
+        Returns:
+            (loss, logits) with labels, else (logits,)
+        """
+        hidden_states = self.electra(input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)[0]
+        return _classify(self, hidden_states, entity_starts, labels)
@@ -0,0 +1,156 @@
+import time
+import sys
+
+from utils import load_tokenizer, set_seed, MODEL_PATH_MAP
+
+print_w_time = lambda elapsed: print("\t완료 ({}초 소요)".format(elapsed))
+
+
+def load_datasets(args, mode, data_dir):
+    """Loads the `mode` split of every task; returns a dict of task name to dataset."""
+    import data_loader
+    import data_loader_tlink
+    from trainer_multitask import get_task_args
+
+    datasets = {}
+    for task in args["tasks"]:
+        task_args = get_task_args(args, task)
+        task_args["data_dir"] = data_dir
+        loader = data_loader_tlink if task_args["task"] == "tlink-re" else data_loader
+        datasets[task] = loader.load_and_cache_examples(task_args, tokenizer, mode=mode)
+    return datasets
+
+
+def train(args):
+    # torch and the model classes are only imported once the arguments are validated
+    from distributed import init_distributed
+    from trainer_multitask import MultiTaskTrainer
+
+    # Data-parallel when launched with torchrun (e.g. torchrun --nproc_per_node=4 multitask.py train kobert)
+    init_distributed(args["ddp_backend"])
+    set_seed(args)
+
+    print("> train_dataset 데이터 로딩: ", end="")
+    start = time.time()
+    train_datasets = load_datasets(args, "train", data_path + 'Train/AI모델링/')
+    print_w_time(time.time() - start)
+
+    print("> dev_dataset 데이터 로딩: ", end="")
+    start = time.time()
+    dev_datasets = load_datasets(args, "dev", data_path + 'Validation/AI모델링/')
+    print_w_time(time.time() - start)
+
+    print("> 학습객체 trainer 생성: ", end="")
+    start = time.time()
+    trainer = MultiTaskTrainer(args, train_datasets, dev_datasets, None, tokenizer)
+    print_w_time(time.time() - start)
+
+    print("> 학습(trainer.train)...")
+    start = time.time()
+    trainer.train()
+    print_w_time(time.time() - start)
+
+    print("> 학습된 모델 저장(trainer.save_model): {}".format(args['model_dir']), end="")
+    start = time.time()
+    trainer.save_model()
+    print_w_time(time.time() - start)
+
+
+def test(args):
+    # torch and the model classes are only imported once the arguments are validated
+    from trainer_multitask import MultiTaskTrainer
+
+    print("> argument")
+    print(args)
+    print()
+
+    print("> test_dataset 데이터 로딩: ", end="")
+    start = time.time()
+    test_datasets = load_datasets(args, "test", data_path + 'Test/AI모델링/')
+    print_w_time(time.time() - start)
+
+    print("> 학습된 모델 불러오기(trainer.load_model): {}".format(args['model_dir']), end="")
+    start = time.time()
+    trainer = MultiTaskTrainer(args, None, None, test_datasets, tokenizer)
+    trainer.load_model()
+    print_w_time(time.time() - start)
+
+    print("> 테스트(trainer.evaluate)...")
+    start = time.time()
+    trainer.evaluate("test", "final", show_detail=True)
+    print_w_time(time.time() - start)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Usage:  $ python3 multitask.py train|test kobert|koelectra")
+        exit()
+    run_mode = sys.argv[1]
+    model_type = sys.argv[2]
+    if run_mode not in ["train", "test"]:
+        print("Invalid run mode:", run_mode)
+        exit()
+    if model_type not in ["kobert", "koelectra"]:
+        print("Invalid model type:", model_type)
+        exit()
+
+    if model_type == 'koelectra':
+        model_type += '-base'
+
+    model_type += '-multitask'
+
+    data_path = './data_path/'
+    args = {
+        "task": "multitask",
+        # One shared encoder; the files and data task of each head
+        "tasks": {
+            "event": {"task": "naver-ner", "train_file": "event.train", "test_file": "event.test",
+                      "val_file": "event.val", "label_file": "label.event"},
+            "timex3": {"task": "naver-ner", "train_file": "timex3.train", "test_file": "timex3.test",
+                       "val_file": "timex3.val", "label_file": "label.timex3"},
+            "tlink": {"task": "tlink-re", "train_file": "tlink.train", "test_file": "tlink.test",
+                      "val_file": "tlink.val", "label_file": "label.tlink"},
+        },
+        "model_dir": "./model_multitask_{}".format(model_type),
+        "data_dir": data_path,
+        "model_type": model_type,
+        "seed": 42,
+        "train_batch_size": 64,
+        "eval_batch_size": 64,
+        "max_seq_len": 100,
+        "token_cache_size": 65536,
+        "feature_chunk_size": 10000,
+        "featurize_workers": 0,  # 0: one process per CPU core
+        "mixed_precision": "no",  # no, bf16 (CPU or GPU) or fp16 (GPU, with loss scaling)
+        "ddp_backend": "gloo",  # Process group backend under torchrun: gloo (CPU hosts) or nccl
+        "learning_rate": 5e-5,
+        "num_train_epochs": 40.0,
+        "weight_decay": 0.0,
+        "gradient_accumulation_steps": 1,
+        "adam_epsilon": 1e-8,
+        "max_grad_norm": 1.0,
+        "max_steps": -1,
+        "patience": 2,
+        "warmup_steps": 0,
+        "logging_steps": 1000,
+        "save_steps": 1000,
+        "do_train": False,
+        "do_eval": False,
+        "no_cuda": False
+    }
+    args["model_name_or_path"] = MODEL_PATH_MAP[args["model_type"]]
+
+    print("> 토크나이저 로딩: ", end="")
+    start = time.time()
+    tokenizer = load_tokenizer(args)
+    # The TLINK markers; the NER inputs never contain them
+    special_token_dict = {'additional_special_tokens': ['[B1]', '[E1]', '[B2]', '[E2]']}
+    tokenizer.add_special_tokens(special_token_dict)
+    print_w_time(time.time() - start)
+
+    if run_mode == 'train':
+        args["do_train"] = True
+        train(args)
+    elif run_mode == 'test':
+        args["do_eval"] = True
+        test(args)
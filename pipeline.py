@@ -0,0 +1,191 @@
+import sys
+import json
+import time
+import logging
+
+from feature_cache import iter_chunks
+from metrics import SpanMetric
+from token_cache import get_token_cache
+from utils import init_logger
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAIR_TYPES = (("event", "event"), ("event", "timex3"), ("timex3", "event"))
+
+
+class Pipeline(object):
+    """
+    Raw text to temporal relations in one pass: the event and timex3 models tag each sentence,
+    the entity pairs of the sentence are enumerated in text order, the [B1] [E1] [B2] [E2] markers
+    are inserted around them as in the TLINK training files, and the TLINK model classifies the pairs.
+    The pairs of a whole chunk of sentences are classified together, sorted by length into batches,
+    and the words of a sentence are tokenized once for all its pairs (token cache).
+    `from_multitask` builds it on one multi-task model_dir instead: event and timex3 are then tagged on one
+    encoder pass, and the TLINK head shares the loaded encoder.
+    Args:
+        event_dir, timex3_dir, tlink_dir: Trained model dirs (see inference.Predictor).
+        pair_types: (first, second) entity kinds to classify, the first one earlier in the sentence.
+        suffix: NER labels are suffixes (`EVENT-B`), as Trainer scores them; False for prefixes (`B-EVENT`).
+        predictor_kwargs: batch_size, chunk_size, mixed_precision, no_cuda of the predictors.
+    """
+
+    def __init__(self, event_dir, timex3_dir, tlink_dir, pair_types=DEFAULT_PAIR_TYPES, suffix=True, **predictor_kwargs):
+        from inference import Predictor
+
+        self._setup({"event": Predictor(event_dir, **predictor_kwargs), "timex3": Predictor(timex3_dir, **predictor_kwargs)},
+                    Predictor(tlink_dir, **predictor_kwargs), pair_types, suffix)
+
+    @classmethod
+    def from_multitask(cls, model_dir, pair_types=DEFAULT_PAIR_TYPES, suffix=True, **predictor_kwargs):
+        """
+        Args:
+            model_dir: Directory written by MultiTaskTrainer.save_model, with event, timex3 and tlink heads.
+        """
+        from inference import Predictor
+
+        tagger = Predictor(model_dir, heads=("event", "timex3"), **predictor_kwargs)
+        pipeline = cls.__new__(cls)
+        pipeline._setup({"event": tagger, "timex3": tagger}, tagger.with_heads(("tlink",)), pair_types, suffix)
+        return pipeline
+
+    def _setup(self, taggers, tlink, pair_types, suffix):
+        """
+        Args:
+            taggers: dict of entity kind to the Predictor tagging it; a multi-task predictor may tag several kinds.
+            tlink: Predictor of the relations.
+        """
+        self.taggers = taggers
+        self.tlink = tlink
+        self.pair_types = set(tuple(pair_type) for pair_type in pair_types)
+        self.chunk_size = self.tlink.chunk_size
+        id2labels = {kind: tagger.id2labels[kind] if tagger.is_multitask else tagger.id2label
+                     for kind, tagger in self.taggers.items()}
+        self.span_metrics = {kind: SpanMetric(list(id2label), suffix=suffix) for kind, id2label in id2labels.items()}
+        self.label2id = {kind: {label: i for i, label in enumerate(id2label)} for kind, id2label in id2labels.items()}
+        self.token_cache = get_token_cache(self.tlink.tokenizer)
+        # The [B2] marker has to survive the truncation to max_seq_len ([CLS] and [SEP] included)
+        self.max_marker_position = self.tlink.args["max_seq_len"] - 2
+
+    def _entities(self, kind, sentence, tags):
+        span_metric = self.span_metrics[kind]
+        label_ids = [self.label2id[kind][tag] for tag in tags]
+        types, begins, ends = span_metric.get_entities(label_ids, [len(label_ids)])
+        return [{"kind": kind, "type": span_metric.type_names[t], "start": int(b), "end": int(e) + 1,
+                 "text": sentence[b:e + 1]} for t, b, e in zip(types, begins, ends)]
+
+    def _mark(self, sentence, first, second):
+        """The sentence with the TLINK markers around two entities, as whitespace-separated words."""
+        text = " ".join([sentence[:first["start"]], "[B1]", sentence[first["start"]:first["end"]], "[E1]",
+                         sentence[first["end"]:second["start"]], "[B2]", sentence[second["start"]:second["end"]], "[E2]",
+                         sentence[second["end"]:]])
+        return " ".join(text.split())
+
+    def _fits(self, marked):
+        position = 1  # [CLS]
+        for word in marked.split():
+            if word == "[B2]":
+                return position <= self.max_marker_position
+            position += len(self.token_cache.lookup(word))
+        return False
+
+    def candidate_pairs(self, sentence, entities):
+        """
+        Returns:
+            List of (first entity index, second entity index, marked sentence) for the non-overlapping
+            entity pairs of `pair_types` whose markers fit into max_seq_len
+        """
+        pairs = []
+        for i, first in enumerate(entities):
+            for j, second in enumerate(entities):
+                if first["end"] > second["start"] or (first["kind"], second["kind"]) not in self.pair_types:
+                    continue
+                marked = self._mark(sentence, first, second)
+                if self._fits(marked):
+                    pairs.append((i, j, marked))
+        return pairs
+
+    def run_batch(self, sentences):
+        """
+        Args:
+            sentences: List of raw sentences.
+        Returns:
+            One dict per sentence: the sentence, its entities (kind, type, character start/end, text)
+            in text order, and its tlinks (source/target entity indexes and relation)
+        """
+        entities = [[] for _ in sentences]
+        # A tagger of several kinds (multi-task) runs once for all of them
+        predictions = {}
+        for kind, tagger in self.taggers.items():
+            if id(tagger) not in predictions:
+                predictions[id(tagger)] = tagger.predict_batch(sentences)
+            for sentence_entities, sentence, tags in zip(entities, sentences, predictions[id(tagger)]):
+                if isinstance(tags, dict):
+                    tags = tags[kind]
+                sentence_entities.extend(self._entities(kind, sentence, tags))
+        for sentence_entities in entities:
+            sentence_entities.sort(key=lambda entity: (entity["start"], entity["end"]))
+
+        # The pairs of all sentences go through the TLINK model together
+        pairs = [self.candidate_pairs(sentence, sentence_entities) for sentence, sentence_entities in zip(sentences, entities)]
+        marked = [text for sentence_pairs in pairs for _, _, text in sentence_pairs]
+        relations = iter(self.tlink.predict_batch(marked) if marked else [])
+
+        results = []
+        for sentence, sentence_entities, sentence_pairs in zip(sentences, entities, pairs):
+            tlinks = [{"source": i, "target": j, "relation": next(relations)} for i, j, _ in sentence_pairs]
+            results.append({"sentence": sentence, "entities": sentence_entities, "tlinks": tlinks})
+        return results
+
+    def run(self, sentences):
+        """
+        Args:
+            sentences: Iterable of raw sentences, consumed lazily.
+        Returns:
+            Generator of the `run_batch` results in input order
+        """
+        for chunk in iter_chunks(sentences, self.chunk_size):
+            yield from self.run_batch(chunk)
+
+
+if __name__ == '__main__':
+    positional = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if len(positional) < 1:
+        print("Usage:  $ python3 pipeline.py kobert|koelectra [input_file|-] [output_file] [--entity-marker|--multitask]")
+        print("  Tags one raw sentence per line (stdin by default) and writes one JSON object per line")
+        print("  --entity-marker: Use the TLINK model trained with tlink.py --entity-marker")
+        print("  --multitask: Use the multi-task model (multitask.py) instead of the event, timex3 and tlink models")
+        exit()
+    model_type = positional[0]
+    if model_type not in ["kobert", "koelectra"]:
+        print("Invalid model type:", model_type)
+        exit()
+    if model_type == 'koelectra':
+        model_type += '-base'
+    # As tlink.py names its model dirs
+    tlink_model_type = model_type + ('-tlink-em' if "--entity-marker" in sys.argv[1:] else '-tlink')
+    input_file = positional[1] if len(positional) > 1 else "-"
+    output_file = positional[2] if len(positional) > 2 else None
+
+    init_logger()
+    if "--multitask" in sys.argv[1:]:
+        pipeline = Pipeline.from_multitask("./model_multitask_{}-multitask".format(model_type))
+    else:
+        pipeline = Pipeline("./model_event_{}".format(model_type), "./model_timex3_{}".format(model_type),
+                            "./model_tlink_{}".format(tlink_model_type))
+    start = time.time()
+    input_lines = sys.stdin if input_file == "-" else open(input_file, "r", encoding="utf-8")
+    output = open(output_file, "w", encoding="utf-8") if output_file else sys.stdout
+    num_sentences = num_tlinks = 0
+    try:
+        for result in pipeline.run(line.rstrip("\n") for line in input_lines):
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            num_sentences += 1
+            num_tlinks += len(result["tlinks"])
+    finally:
+        if input_lines is not sys.stdin:
+            input_lines.close()
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.time() - start
+    logger.info("%d sentences, %d tlinks in %.1fs (%.1f sentences/sec)", num_sentences, num_tlinks, elapsed,
+                num_sentences / elapsed if elapsed > 0 else 0.0)
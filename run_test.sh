@@ -5,3 +5,17 @@ python3 event.py test koelectra > log.event.test.koelectra
 python3 tlink.py test kobert > log.tlink.test.kobert
 python3 tlink.py test koelectra > log.tlink.test.koelectra
 
+
+# Tagging raw, unlabeled sentences (one per line) with a trained model:
+#   python3 inference.py ./model_event_kobert sentences.txt sentences.event.txt
+# Serving the trained event/timex3/tlink models over HTTP (POST /predict/event {"sentences": [...]}, GET /stats):
+#   python3 server.py kobert 8000
+# Raw text -> event/timex3 spans -> TLINK relations of their pairs, one JSON object per sentence:
+#   python3 pipeline.py kobert raw_sentences.txt tlinks.jsonl
+# The same with the multi-task model (event and timex3 tagged on one encoder pass):
+#   python3 inference.py ./model_multitask_kobert-multitask sentences.txt sentences.tags.txt
+#   python3 server.py kobert 8000 --multitask
+#   python3 pipeline.py kobert raw_sentences.txt tlinks.jsonl --multitask
+# With the entity-marker TLINK model (./model_tlink_kobert-tlink-em):
+#   python3 server.py kobert 8000 --entity-marker
+#   python3 pipeline.py kobert raw_sentences.txt tlinks.jsonl --entity-marker
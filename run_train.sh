@@ -1,7 +1,15 @@
+# Data-parallel training on several processes/nodes (gloo on CPU hosts):
+#   torchrun --nproc_per_node=4 event.py train kobert
+# A pre-empted run continues from its latest checkpoint with:
+#   python3 event.py train kobert --resume
 python3 timex3.py train kobert > log.timex3.train.kobert
 python3 timex3.py train koelectra > log.timex3.train.koelectra
 python3 event.py train kobert > log.event.train.kobert
 python3 event.py train koelectra > log.event.train.koelectra
 python3 tlink.py train kobert > log.tlink.train.kobert
 python3 tlink.py train koelectra > log.tlink.train.koelectra
+# One shared encoder for event, timex3 and tlink (instead of three models):
+#   python3 multitask.py train kobert > log.multitask.train.kobert
 
+# TLINK classified from the [B1]/[B2] marker states instead of [CLS] (saved to ./model_tlink_kobert-tlink-em):
+#   python3 tlink.py train kobert --entity-marker > log.tlink-em.train.kobert
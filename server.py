@@ -0,0 +1,358 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from utils import init_logger
+
+logger = logging.getLogger(__name__)
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class LatencyStats(object):
+    """Request latencies (and micro-batch sizes) over the last `window` requests."""
+
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.num_requests = 0
+        self.num_sentences = 0
+        self.num_errors = 0
+
+    def add(self, latency, num_sentences):
+        self.latencies.append(latency)
+        self.num_requests += 1
+        self.num_sentences += num_sentences
+
+    def summary(self):
+        results = {
+            "requests": self.num_requests,
+            "sentences": self.num_sentences,
+            "errors": self.num_errors,
+            "mean_batch_size": float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+        }
+        if self.latencies:
+            p50, p90, p99 = np.percentile(np.array(self.latencies) * 1000, [50, 90, 99])
+            results.update(latency_ms_p50=p50, latency_ms_p90=p90, latency_ms_p99=p99,
+                           latency_ms_max=max(self.latencies) * 1000)
+        return results
+
+
+class MicroBatcher(object):
+    """
+    Coalesces the concurrent requests of one model into micro-batches. The first request of a
+    micro-batch waits at most `max_latency_ms` for others to join, and a micro-batch is closed early
+    when it has `max_batch_size` sentences. Tokenization runs on a thread of its own and the forward
+    pass on another, so the next micro-batch is tokenized while the current one runs; both are
+    single-threaded per model, which keeps the model's token cache to one thread. Batchers whose
+    predictors share a tokenizer (and so its token cache) or a model have to share these threads too.
+    Args:
+        predictor: inference.Predictor of the model.
+        max_batch_size: Sentences per micro-batch.
+        max_latency_ms: Longest wait for a micro-batch to fill up.
+        tokenize_pool, model_pool: Single-thread executors shared with other batchers; by default
+            the batcher starts (and shuts down) its own.
+    """
+
+    def __init__(self, predictor, max_batch_size=64, max_latency_ms=10.0, tokenize_pool=None, model_pool=None):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.stats = LatencyStats()
+        self._queue = asyncio.Queue()
+        self._own_tokenize_pool = tokenize_pool is None
+        self._own_model_pool = model_pool is None
+        self._tokenize_pool = tokenize_pool or ThreadPoolExecutor(max_workers=1, thread_name_prefix="tokenize")
+        self._model_pool = model_pool or ThreadPoolExecutor(max_workers=1, thread_name_prefix="model")
+        # At most two micro-batches in flight: one tokenizing, one in the model
+        self._in_flight = asyncio.Semaphore(2)
+        self._num_featurized = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._own_tokenize_pool:
+            self._tokenize_pool.shutdown(wait=True)
+        if self._own_model_pool:
+            self._model_pool.shutdown(wait=True)
+
+    async def predict(self, sentences):
+        """Queues the sentences of one request; returns their predictions once its micro-batch ran."""
+        future = asyncio.get_event_loop().create_future()
+        await self._queue.put((sentences, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            requests = [await self._queue.get()]
+            num_sentences = len(requests[0][0])
+            deadline = loop.time() + self.max_latency
+            while num_sentences < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                requests.append(request)
+                num_sentences += len(request[0])
+            await self._in_flight.acquire()
+            asyncio.ensure_future(self._process(requests))
+
+    async def _run_batch(self, sentences):
+        loop = asyncio.get_event_loop()
+        # Sentences are numbered over the server's lifetime (the data loaders log only the first few examples)
+        start_index, self._num_featurized = self._num_featurized, self._num_featurized + len(sentences)
+        examples, dataset = await loop.run_in_executor(self._tokenize_pool, self.predictor.featurize, sentences, start_index)
+        return await loop.run_in_executor(self._model_pool, self.predictor.forward, examples, dataset)
+
+    async def _process(self, requests):
+        try:
+            self.stats.batch_sizes.append(sum(len(sentences) for sentences, _ in requests))
+            await self._complete(requests)
+        finally:
+            self._in_flight.release()
+
+    async def _complete(self, requests):
+        sentences = [sentence for request_sentences, _ in requests for sentence in request_sentences]
+        try:
+            predictions = await self._run_batch(sentences)
+        except Exception as e:
+            if isinstance(e, ValueError) and len(requests) > 1:
+                # An invalid sentence fails only its own request
+                for request in requests:
+                    await self._complete([request])
+                return
+            for _, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        start = 0
+        for request_sentences, future in requests:
+            if not future.done():
+                future.set_result(predictions[start:start + len(request_sentences)])
+            start += len(request_sentences)
+
+
+class ModelServer(object):
+    """
+    Minimal asyncio HTTP/1.1 server (keep-alive, JSON bodies) around one MicroBatcher per model.
+        POST /predict/<model>  {"sentences": [...]}  ->  {"predictions": [...]}
+        GET  /stats            request counts, micro-batch sizes and latency percentiles per model
+        GET  /health
+    Args:
+        predictors: dict of model name (e.g. "event") to inference.Predictor. Predictors sharing a
+            tokenizer or a model (Predictor.with_heads) share the tokenize or the model thread.
+    """
+
+    def __init__(self, predictors, host="127.0.0.1", port=8000, max_batch_size=64, max_latency_ms=10.0):
+        self.host = host
+        self.port = port
+        # Keyed by id() of the shared tokenizer/model
+        self._shared_pools = {}
+        self.batchers = {}
+        for name, predictor in predictors.items():
+            self.batchers[name] = MicroBatcher(predictor, max_batch_size, max_latency_ms,
+                                               tokenize_pool=self._shared_pool("tokenize", predictor.tokenizer),
+                                               model_pool=self._shared_pool("model", predictor.model))
+        self._server = None
+
+    def _shared_pool(self, kind, shared):
+        key = (kind, id(shared))
+        if key not in self._shared_pools:
+            self._shared_pools[key] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=kind)
+        return self._shared_pools[key]
+
+    async def start(self):
+        for batcher in self.batchers.values():
+            batcher.start()
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        # The actual port when started on port 0
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("Serving %s on http://%s:%d", ", ".join(sorted(self.batchers)), self.host, self.port)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for batcher in self.batchers.values():
+            await batcher.close()
+        for pool in self._shared_pools.values():
+            pool.shutdown(wait=True)
+        self.log_stats()
+
+    def stats(self):
+        return {name: batcher.stats.summary() for name, batcher in self.batchers.items()}
+
+    def log_stats(self):
+        for name, summary in sorted(self.stats().items()):
+            logger.info("%s: %s", name, json.dumps(summary))
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, response = await self._dispatch(method, path, body)
+                payload = json.dumps(response, ensure_ascii=False).encode("utf-8")
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json; charset=utf-8\r\n"
+                             "Content-Length: {}\r\nConnection: {}\r\n\r\n".format(
+                                 status, HTTP_REASONS[status], len(payload), "keep-alive" if keep_alive else "close"
+                             ).encode("latin-1") + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, path, body):
+        if path == "/health":
+            return 200, {"status": "ok", "models": sorted(self.batchers)}
+        if path == "/stats":
+            return 200, self.stats()
+        if not path.startswith("/predict/"):
+            return 404, {"error": "Unknown path {}".format(path)}
+        batcher = self.batchers.get(path[len("/predict/"):])
+        if batcher is None:
+            return 404, {"error": "Unknown model; serving {}".format(sorted(self.batchers))}
+        if method != "POST":
+            return 405, {"error": "Use POST"}
+
+        start = time.perf_counter()
+        try:
+            sentences = json.loads(body.decode("utf-8"))["sentences"]
+            if not isinstance(sentences, list) or not all(isinstance(sentence, str) for sentence in sentences):
+                raise ValueError("sentences has to be a list of strings")
+            predictions = await batcher.predict(sentences)
+        except (ValueError, KeyError, TypeError) as e:
+            batcher.stats.num_errors += 1
+            return 400, {"error": str(e)}
+        except Exception as e:
+            logger.exception("Prediction failed")
+            batcher.stats.num_errors += 1
+            return 500, {"error": str(e)}
+        batcher.stats.add(time.perf_counter() - start, len(sentences))
+        return 200, {"predictions": predictions}
+
+
+async def fetch(host, port, method, path, payload=None):
+    """
+    A local client: sends one request (JSON payload) and returns (status, decoded JSON response).
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8") if payload is not None else b""
+    writer.write("{} {} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n"
+                 "Connection: close\r\n\r\n".format(method, path, host, len(body)).encode("latin-1") + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        headers[key.strip().lower()] = value.strip()
+    response = await reader.readexactly(int(headers["content-length"]))
+    writer.close()
+    return status, json.loads(response.decode("utf-8"))
+
+
+async def serve(args):
+    from inference import Predictor
+
+    predictors = {}
+    if args["multitask"]:
+        # One loaded multi-task model behind every route: a route per head, and "ner" for event and
+        # timex3 on one encoder pass
+        multitask = Predictor(args["multitask"], batch_size=args["max_batch_size"],
+                              mixed_precision=args["mixed_precision"], no_cuda=args["no_cuda"])
+        predictors = {head: multitask.with_heads((head,)) for head in multitask.model.task_labels}
+        predictors["ner"] = multitask
+    else:
+        for name, model_dir in args["models"].items():
+            if not os.path.exists(os.path.join(model_dir, "training_args.bin")):
+                logger.warning("No trained model in %s, not serving %s", model_dir, name)
+                continue
+            predictors[name] = Predictor(model_dir, batch_size=args["max_batch_size"],
+                                         mixed_precision=args["mixed_precision"], no_cuda=args["no_cuda"])
+    if not predictors:
+        raise ValueError("No trained model to serve: {}".format(args["models"]))
+
+    server = ModelServer(predictors, args["host"], args["port"], args["max_batch_size"], args["max_latency_ms"])
+    await server.start()
+    try:
+        while True:
+            await asyncio.sleep(args["stats_interval"])
+            server.log_stats()
+    finally:
+        await server.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage:  $ python3 server.py kobert|koelectra [port] [--entity-marker|--multitask]")
+        print("  --entity-marker: Serve the TLINK model trained with tlink.py --entity-marker")
+        print("  --multitask: Serve the multi-task model (multitask.py) instead of the event, timex3 and tlink models")
+        exit()
+    positional = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    model_type = positional[0]
+    if model_type not in ["kobert", "koelectra"]:
+        print("Invalid model type:", model_type)
+        exit()
+    if model_type == 'koelectra':
+        model_type += '-base'
+    # As tlink.py names its model dirs
+    tlink_model_type = model_type + ('-tlink-em' if "--entity-marker" in sys.argv[1:] else '-tlink')
+
+    init_logger()
+    args = {
+        "host": "127.0.0.1",
+        "port": int(positional[1]) if len(positional) > 1 else 8000,
+        "models": {
+            "event": "./model_event_{}".format(model_type),
+            "timex3": "./model_timex3_{}".format(model_type),
+            "tlink": "./model_tlink_{}".format(tlink_model_type),
+        },
+        # A multi-task model_dir to serve instead of "models"
+        "multitask": "./model_multitask_{}-multitask".format(model_type) if "--multitask" in sys.argv[1:] else None,
+        "max_batch_size": 64,  # Sentences per micro-batch
+        "max_latency_ms": 10.0,  # How long a request may wait for others to share its micro-batch
+        "stats_interval": 60,  # Seconds between the latency logs
+        "mixed_precision": "no",
+        "no_cuda": False
+    }
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
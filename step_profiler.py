@@ -0,0 +1,170 @@
+import os
+import csv
+import json
+import time
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+PHASES = ("data", "h2d", "forward", "backward", "optimizer", "eval", "save")
+
+
+class StepProfiler(object):
+    """
+    Per-step timings of the training loop: waiting for the batch (data), host-to-device copy (h2d),
+    forward, backward, optimizer step, and the eval/save pauses, with examples/sec and (non-pad)
+    tokens/sec. Every training step (micro-batch) is one row of a JSONL or CSV timeline. On GPU the
+    device is synchronized around each phase, so the timings are real but the steps get a bit slower;
+    when disabled, every call is a no-op.
+    Optionally a torch.profiler trace covers a window of optimization steps.
+    Args:
+        profile_file: Timeline file, `.csv` or `.jsonl` (None: no timeline).
+        torch_profile_steps: (first, last) global steps to capture with torch.profiler (None: no trace).
+            The trace is written next to the timeline (or to trace_dir) as a Chrome trace.
+        device: Device of the training, e.g. "cpu" or "cuda:0".
+        trace_dir: Directory of the trace when there is no profile_file.
+    """
+
+    def __init__(self, profile_file=None, torch_profile_steps=None, device="cpu", trace_dir="."):
+        self.enabled = profile_file is not None or torch_profile_steps is not None
+        self.profile_file = profile_file
+        self.torch_profile_steps = tuple(torch_profile_steps) if torch_profile_steps is not None else None
+        self.synchronize = torch.device(device).type == "cuda"
+        if torch_profile_steps is None:
+            self.trace_file = None
+        elif profile_file is not None:
+            self.trace_file = os.path.splitext(profile_file)[0] + ".trace.json"
+        else:
+            self.trace_file = os.path.join(trace_dir, "torch_trace.json")
+
+        self._file = None
+        self._csv_writer = None
+        self._torch_profiler = None
+        self._row = None
+        self._last_end = None
+        self._totals = OrderedDict((name, 0.0) for name in PHASES + ("total",))
+        self._num_steps = 0
+        self._num_examples = 0
+        self._num_tokens = 0
+
+    def _now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def start(self):
+        """Opens the timeline; call it right before the training loop."""
+        if self.profile_file is None:
+            return
+        profile_dir = os.path.dirname(self.profile_file)
+        if profile_dir and not os.path.exists(profile_dir):
+            os.makedirs(profile_dir)
+        self._file = open(self.profile_file, "w", encoding="utf-8", newline="")
+        if self.profile_file.endswith(".csv"):
+            fieldnames = ["global_step", "epoch", "examples", "tokens"] + list(PHASES) + ["total", "examples_per_sec", "tokens_per_sec"]
+            self._csv_writer = csv.DictWriter(self._file, fieldnames=fieldnames)
+            self._csv_writer.writeheader()
+
+    def epoch_begin(self):
+        """The time until the first batch of the epoch (building the iterator) counts as data loading."""
+        if self.enabled:
+            self._last_end = self._now()
+
+    def step_begin(self, global_step):
+        """Call it first thing in a training step: the time since the previous step was spent loading the batch."""
+        if not self.enabled:
+            return
+        now = self._now()
+        self._row = OrderedDict((name, 0.0) for name in PHASES)
+        self._row["data"] = now - (self._last_end if self._last_end is not None else now)
+        self._step_start = now - self._row["data"]
+
+        if self.torch_profile_steps is not None and self._torch_profiler is None \
+                and self.torch_profile_steps[0] <= global_step + 1 <= self.torch_profile_steps[1]:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.synchronize:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._torch_profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            self._torch_profiler.__enter__()
+            logger.info("torch.profiler capture started at global step %d", global_step + 1)
+
+    @contextmanager
+    def phase(self, name):
+        """Times the block as phase `name` of the current step."""
+        if not self.enabled:
+            yield
+            return
+        start = self._now()
+        try:
+            yield
+        finally:
+            self._row[name] += self._now() - start
+
+    def step_end(self, global_step, epoch, examples, tokens):
+        """
+        Args:
+            global_step: Optimization steps done after this step.
+            examples: Examples in the batch.
+            tokens: Non-pad tokens in the batch.
+        """
+        if not self.enabled:
+            return
+        self._last_end = self._now()
+        row = self._row
+        row["total"] = self._last_end - self._step_start
+        train_time = row["total"] - row["eval"] - row["save"]
+        for name, value in row.items():
+            self._totals[name] += value
+        self._num_steps += 1
+        self._num_examples += examples
+        self._num_tokens += tokens
+
+        if self._file is not None:
+            record = OrderedDict([("global_step", global_step), ("epoch", epoch), ("examples", examples), ("tokens", tokens)])
+            record.update((name, round(value, 6)) for name, value in row.items())
+            record["examples_per_sec"] = round(examples / train_time, 2) if train_time > 0 else None
+            record["tokens_per_sec"] = round(tokens / train_time, 2) if train_time > 0 else None
+            if self._csv_writer is not None:
+                self._csv_writer.writerow(record)
+            else:
+                self._file.write(json.dumps(record) + "\n")
+
+        if self._torch_profiler is not None and global_step >= self.torch_profile_steps[1]:
+            self._stop_torch_profiler()
+
+    def _stop_torch_profiler(self):
+        self._torch_profiler.__exit__(None, None, None)
+        self._torch_profiler.export_chrome_trace(self.trace_file)
+        logger.info("torch.profiler trace written to %s\n%s", self.trace_file,
+                    self._torch_profiler.key_averages().table(sort_by="self_cpu_time_total", row_limit=20))
+        self._torch_profiler = None
+        # Captured once
+        self.torch_profile_steps = None
+
+    def summary(self):
+        """Mean seconds per step of every phase, and the throughput of the training (eval/save pauses excluded)."""
+        steps = max(self._num_steps, 1)
+        results = OrderedDict(("{}_sec_per_step".format(name), value / steps) for name, value in self._totals.items())
+        train_time = self._totals["total"] - self._totals["eval"] - self._totals["save"]
+        results["examples_per_sec"] = self._num_examples / train_time if train_time > 0 else 0.0
+        results["tokens_per_sec"] = self._num_tokens / train_time if train_time > 0 else 0.0
+        return results
+
+    def close(self):
+        """Closes the timeline (and a trace window that is still open) and logs the summary."""
+        if not self.enabled:
+            return
+        if self._torch_profiler is not None:
+            self._stop_torch_profiler()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            logger.info("Step timeline written to %s", self.profile_file)
+        if self._num_steps > 0:
+            logger.info("***** Step profile (%d steps) *****", self._num_steps)
+            for key, value in self.summary().items():
+                logger.info("  %s = %.4f", key, value)
@@ -0,0 +1,69 @@
+import os
+import sys
+import json
+import subprocess
+
+# Wall-time budgets (seconds). The entry points only need utils until the arguments are validated;
+# the training/inference modules add little on top of torch itself.
+ENTRY_POINT_BUDGET = 1.0
+OVER_TORCH_BUDGET = 1.5
+
+# Only the metric references in utils (f1_pre_rec, show_report) may import these
+REFERENCE_ONLY = ("pandas", "sklearn", "seqeval")
+
+PROBE = """
+import sys, json, time
+sys.path.insert(0, {repo!r})
+start = time.perf_counter()
+{setup}
+setup_time = time.perf_counter() - start
+start = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"setup": setup_time, "elapsed": elapsed, "modules": sorted(sys.modules)}}))
+"""
+
+
+def _probe(code, setup="pass"):
+    """Runs `code` in a fresh interpreter; returns its import time and the modules loaded at the end."""
+    repo = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.run([sys.executable, "-c", PROBE.format(repo=repo, setup=setup, code=code)],
+                            cwd=repo, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def _loaded(result, package):
+    return [module for module in result["modules"] if module == package or module.startswith(package + ".")]
+
+
+def _model_modules(result):
+    # transformers.models.<name> packages are lazy placeholders and models.auto only holds name mappings;
+    # the modeling files are the heavy part
+    return [module for module in result["modules"] if module.startswith("transformers.models.")
+            and not module.startswith("transformers.models.auto.") and module.rsplit(".", 1)[-1].startswith("modeling_")]
+
+
+def test_entry_points_import_without_torch():
+    result = _probe("import utils, event, timex3, tlink, multitask, pipeline, server")
+    for package in REFERENCE_ONLY + ("torch", "transformers"):
+        assert not _loaded(result, package), package
+    assert result["elapsed"] < ENTRY_POINT_BUDGET
+
+
+def test_training_and_inference_modules_skip_reference_metrics():
+    result = _probe("import trainer, trainer_tlink, trainer_multitask, data_loader, data_loader_tlink, inference",
+                    setup="import torch")
+    for package in REFERENCE_ONLY:
+        assert not _loaded(result, package), package
+    assert not _model_modules(result)
+    assert result["elapsed"] < OVER_TORCH_BUDGET
+
+
+def test_model_classes_import_only_the_requested_model():
+    result = _probe("import utils; utils.MODEL_CLASSES['kobert']; utils.MODEL_CLASSES['kobert-tlink']")
+    assert _model_modules(result) == ["transformers.models.bert.modeling_bert"]
+    for package in REFERENCE_ONLY:
+        assert not _loaded(result, package), package
+
+    result = _probe("import utils; utils.MODEL_CLASSES['koelectra-base']")
+    assert _model_modules(result) == ["transformers.models.electra.modeling_electra"]
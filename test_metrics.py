@@ -0,0 +1,104 @@
+import random
+import warnings
+
+import numpy as np
+import pytest
+
+pytest.importorskip("seqeval")
+from seqeval.metrics import classification_report, f1_score, precision_score, recall_score
+
+from metrics import SpanMetric
+from utils import f1_pre_rec, show_report
+
+LABEL_SETS = [
+    ['O', 'EVENT-B', 'EVENT-I', 'UNK'],
+    ['O', 'DATE-B', 'DATE-I', 'TIME-B', 'TIME-I', 'DURATION-B', 'DURATION-I', 'SET-B', 'SET-I', 'UNK'],
+    # Malformed tags: other schemes, bare B/I, no type, a type containing the separator
+    ['O', 'X-B', 'X-I', 'X-E', 'X-S', 'Y-B', 'Y-E', 'B', 'I', '.', 'UNK', 'A-B-C-I'],
+]
+PREFIX_LABEL_SETS = [
+    ['O', 'B-EVENT', 'I-EVENT', 'UNK'],
+    ['O', 'B-X', 'I-X', 'E-X', 'S-X', 'B-Y', 'E-Y', 'B', 'I', '.', 'UNK', 'B-C-I-A'],
+]
+
+
+def _random_batches(labels, num_trials, seed):
+    """Random (label ids, pred ids, lengths) batches, label frequencies drawn per label set."""
+    rng = random.Random(seed)
+    weights = [rng.random() for _ in labels]
+    for _ in range(num_trials):
+        lengths = [rng.randint(0, 15) for _ in range(rng.randint(1, 12))]
+        true_ids = [rng.choices(range(len(labels)), weights, k=length) for length in lengths]
+        pred_ids = [rng.choices(range(len(labels)), weights, k=length) for length in lengths]
+        yield true_ids, pred_ids, lengths
+
+
+def _names(labels, sequences):
+    return [[labels[i] for i in sequence] for sequence in sequences]
+
+
+def _score(metric, true_ids, pred_ids, lengths):
+    flat = lambda sequences: np.array([i for sequence in sequences for i in sequence], dtype=np.int64)
+    return metric.score(flat(true_ids), flat(pred_ids), lengths)
+
+
+@pytest.fixture(autouse=True)
+def _quiet_seqeval():
+    # seqeval warns about ill-defined scores (no predicted/true entities)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        yield
+
+
+@pytest.mark.parametrize("labels", LABEL_SETS)
+def test_scores_match_seqeval_suffix(labels):
+    metric = SpanMetric(labels, suffix=True)
+    for true_ids, pred_ids, lengths in _random_batches(labels, 300, seed=len(labels)):
+        true_names, pred_names = _names(labels, true_ids), _names(labels, pred_ids)
+        expected = f1_pre_rec(true_names, pred_names)
+        summary = _score(metric, true_ids, pred_ids, lengths).summary()
+        for key in ("precision", "recall", "f1"):
+            assert summary[key] == pytest.approx(expected[key], abs=1e-12), (key, true_names, pred_names)
+
+
+@pytest.mark.parametrize("labels", LABEL_SETS)
+def test_report_matches_seqeval_suffix(labels):
+    metric = SpanMetric(labels, suffix=True)
+    compared = 0
+    for true_ids, pred_ids, lengths in _random_batches(labels, 300, seed=100 + len(labels)):
+        true_names, pred_names = _names(labels, true_ids), _names(labels, pred_ids)
+        try:
+            expected = show_report(true_names, pred_names)
+        except ValueError:
+            # seqeval cannot report a batch without any entity
+            continue
+        assert _score(metric, true_ids, pred_ids, lengths).report() == expected
+        compared += 1
+    assert compared > 200
+
+
+@pytest.mark.parametrize("labels", PREFIX_LABEL_SETS)
+def test_scores_and_report_match_seqeval_prefix(labels):
+    metric = SpanMetric(labels, suffix=False)
+    for true_ids, pred_ids, lengths in _random_batches(labels, 200, seed=200 + len(labels)):
+        true_names, pred_names = _names(labels, true_ids), _names(labels, pred_ids)
+        scores = _score(metric, true_ids, pred_ids, lengths)
+        summary = scores.summary()
+        assert summary["precision"] == pytest.approx(precision_score(true_names, pred_names), abs=1e-12)
+        assert summary["recall"] == pytest.approx(recall_score(true_names, pred_names), abs=1e-12)
+        assert summary["f1"] == pytest.approx(f1_score(true_names, pred_names), abs=1e-12)
+        try:
+            expected = classification_report(true_names, pred_names)
+        except ValueError:
+            continue
+        assert scores.report() == expected
+
+
+def test_empty_and_all_unk():
+    labels = LABEL_SETS[0]
+    metric = SpanMetric(labels, suffix=True)
+    for true_ids, pred_ids in [([[]], [[]]), ([[3, 3, 0]], [[3, 0, 3]]), ([[1, 2]], [[3, 3]]), ([[3, 3]], [[1, 2]])]:
+        expected = f1_pre_rec(_names(labels, true_ids), _names(labels, pred_ids))
+        summary = _score(metric, true_ids, pred_ids, [len(ids) for ids in true_ids]).summary()
+        for key in ("precision", "recall", "f1"):
+            assert summary[key] == pytest.approx(expected[key], abs=1e-12)
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+import torch
+
+from mixed_precision import MixedPrecision
+
+
+def _model():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.ReLU(), torch.nn.Linear(16, 3))
+
+
+def _train_step(precision, model, optimizer, max_grad_norm=1.0):
+    inputs, labels = torch.randn(4, 8), torch.tensor([0, 1, 2, 1])
+    with precision.autocast():
+        logits = model(inputs)
+        loss = torch.nn.functional.cross_entropy(logits, labels)
+    precision.backward(loss)
+    precision.step(optimizer, model.parameters(), max_grad_norm)
+    optimizer.zero_grad()
+    return logits
+
+
+def test_bf16_autocast_runs_matmuls_in_bf16():
+    precision = MixedPrecision("bf16", "cpu")
+    assert precision.enabled and precision.dtype == torch.bfloat16
+    a, b = torch.randn(4, 8), torch.randn(8, 2)
+    with precision.autocast():
+        assert torch.matmul(a, b).dtype == torch.bfloat16
+        assert torch.nn.functional.linear(a, b.t()).dtype == torch.bfloat16
+    assert torch.matmul(a, b).dtype == torch.float32
+
+
+def test_fp16_on_cpu_falls_back_to_bf16_without_scaler():
+    precision = MixedPrecision("fp16", "cpu")
+    assert precision.mode == "bf16" and precision.dtype == torch.bfloat16
+    assert precision.scaler is None
+    assert precision.state_dict() == {}
+    with precision.autocast():
+        assert torch.matmul(torch.randn(2, 2), torch.randn(2, 2)).dtype == torch.bfloat16
+
+
+def test_no_mode_is_a_noop():
+    precision = MixedPrecision("no", "cpu")
+    assert not precision.enabled and precision.scaler is None
+    with precision.autocast():
+        assert torch.matmul(torch.randn(2, 2), torch.randn(2, 2)).dtype == torch.float32
+
+
+def test_invalid_mode():
+    with pytest.raises(ValueError):
+        MixedPrecision("fp8", "cpu")
+
+
+@pytest.mark.parametrize("mode", ["no", "bf16", "fp16"])
+def test_step_clips_gradients_and_steps(mode):
+    precision = MixedPrecision(mode, "cpu")
+    model = _model()
+    before = [p.detach().clone() for p in model.parameters()]
+    optimizer = torch.optim.SGD(model.parameters(), lr=1.0)
+    inputs, labels = torch.randn(4, 8) * 100, torch.tensor([0, 1, 2, 1])
+    with precision.autocast():
+        loss = torch.nn.functional.cross_entropy(model(inputs), labels) * 100
+    precision.backward(loss)
+    assert torch.nn.utils.clip_grad_norm_(model.parameters(), float("inf")) > 1.0
+
+    precision.step(optimizer, model.parameters(), max_grad_norm=1.0)
+    # With lr=1 the update is the clipped gradient itself
+    update = torch.cat([(b - p.detach()).flatten() for b, p in zip(before, model.parameters())])
+    assert update.abs().sum() > 0
+    assert update.norm() == pytest.approx(1.0, rel=1e-3)
+
+
+def test_weights_and_saved_state_dict_stay_fp32(tmp_path):
+    precision = MixedPrecision("bf16", "cpu")
+    model = _model()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    for _ in range(3):
+        logits = _train_step(precision, model, optimizer)
+    assert logits.dtype == torch.bfloat16
+    assert all(p.dtype == torch.float32 for p in model.parameters())
+
+    path = os.path.join(str(tmp_path), "model.bin")
+    torch.save(model.state_dict(), path)
+    state_dict = torch.load(path)
+    assert state_dict and all(value.dtype == torch.float32 for value in state_dict.values())
+    assert all(value.dtype == torch.float32 for state in optimizer.state_dict()["state"].values()
+               for key, value in state.items() if key != "step")
@@ -0,0 +1,160 @@
+import os
+import random
+import shutil
+
+import pytest
+
+spm = pytest.importorskip("sentencepiece")
+
+from tokenization_kobert import KoBertTokenizer, VOCAB_FILES_NAMES
+
+MARKERS = ['[B1]', '[E1]', '[B2]', '[E2]']
+SYLLABLES = "가나다라마바사아자차카타파하고는을를이에서의와과도로한국어시간사건오늘내일년월일"
+
+
+def _corpus(rng, num_lines=2000):
+    lines = []
+    for _ in range(num_lines):
+        words = []
+        for _ in range(rng.randint(3, 10)):
+            kind = rng.random()
+            if kind < 0.15:
+                words.append("{:,}".format(rng.randint(1, 10 ** 7)))
+            elif kind < 0.25:
+                words.append(str(rng.randint(1, 2030)) + rng.choice(["년", "월", "일", "시"]))
+            else:
+                words.append("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4))))
+        lines.append(" ".join(words) + rng.choice([".", ",", "?", ""]))
+    return lines
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    return _corpus(random.Random(0))
+
+
+@pytest.fixture(scope="module")
+def model_dir(tmp_path_factory, corpus):
+    """A small KoBERT-style tokenizer dir: a SentencePiece model and a vocab.txt missing some of its pieces."""
+    model_dir = tmp_path_factory.mktemp("kobert")
+    corpus_file = model_dir / "corpus.txt"
+    corpus_file.write_text("\n".join(corpus), encoding="utf-8")
+    model_prefix = str(model_dir / os.path.splitext(VOCAB_FILES_NAMES["vocab_file"])[0])
+    spm.SentencePieceTrainer.Train(input=str(corpus_file), model_prefix=model_prefix, vocab_size=400,
+                                   character_coverage=1.0, model_type="unigram", minloglevel=2)
+    sp_model = spm.SentencePieceProcessor()
+    sp_model.Load(model_prefix + ".model")
+    pieces = [sp_model.IdToPiece(i) for i in range(sp_model.GetPieceSize())]
+    # Every 7th piece is left out so that some known pieces still map to [UNK], and strings SentencePiece
+    # does not know are added so that its unknown pieces only get their id by the surface string lookup
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + [
+        piece for i, piece in enumerate(pieces) if piece not in ('<unk>', '<s>', '</s>') and i % 7 != 3]
+    vocab += ['\u2603', '\u2605', '\u6f22']
+    (model_dir / VOCAB_FILES_NAMES["vocab_txt"]).write_text("\n".join(vocab) + "\n", encoding="utf-8")
+    return model_dir
+
+
+def _load(model_dir):
+    tokenizer = KoBertTokenizer.from_pretrained(str(model_dir))
+    tokenizer.add_special_tokens({'additional_special_tokens': MARKERS})
+    return tokenizer
+
+
+@pytest.fixture(scope="module")
+def tokenizer(model_dir):
+    return _load(model_dir)
+
+
+def _texts(corpus):
+    rng = random.Random(1)
+    words = [word for line in corpus[:300] for word in line.split()]
+    digit_comma = ["1,234", "12,345,678", "1,", "12,", "a1,b", "3,4,5,", "가1,2나", "１,２３４", "2023년 1,000명"]
+    unknown = ["😀", "한국😀어", "☃ ☄ ★", "Ω≈ç√", "漢字 テスト", "ﬁ ① Ⅻ ㎏ ｶ", "é ñ ü", "``인용''", "\t\n 탭"]
+    markers = ["[B1] 오늘 [E1] 에 [B2] 사건 [E2] 이", "[B1]가나[E1][B2]1,234[E2]", "[B1] [E1] [B2] [E2]",
+               "[CLS] 가 [SEP]", "[B1]😀[E1]"]
+    pool = [chr(c) for c in range(0x20, 0x3000)] + [chr(c) for c in range(0xAC00, 0xD7A4, 7)] + list(SYLLABLES + "1,")
+    random_unicode = ["".join(rng.choice(pool) for _ in range(rng.randint(0, 12))) for _ in range(1000)]
+    return corpus[:500] + words + digit_comma + unknown + markers + random_unicode + ["", "  ", ","]
+
+
+def _reference(tokenizer, texts):
+    return [tokenizer.tokenize(text) for text in texts]
+
+
+def test_batch_tokenize_matches_tokenize(tokenizer, corpus):
+    texts = _texts(corpus)
+    assert tokenizer.batch_tokenize(texts) == _reference(tokenizer, texts)
+
+
+def test_encode_batch_to_ids_matches_convert_tokens_to_ids(tokenizer, corpus):
+    texts = _texts(corpus)
+    expected = [tokenizer.convert_tokens_to_ids(tokens) for tokens in _reference(tokenizer, texts)]
+    assert tokenizer.encode_batch_to_ids(texts) == expected
+
+
+def test_inputs_cover_unk_digit_comma_and_markers(tokenizer, corpus):
+    # The parity tests only mean something if the inputs reach the redone and slow paths
+    tokens = [token for pieces in _reference(tokenizer, _texts(corpus)) for token in pieces]
+    ids = tokenizer.convert_tokens_to_ids(tokens)
+    assert tokenizer.unk_token_id in ids
+    assert tokenizer.convert_tokens_to_ids('\u2603') in ids
+    assert "," in tokens and any(piece.lstrip("▁").isdigit() for piece in tokens)
+    assert set(MARKERS) <= set(tokens)
+
+
+def test_single_text_and_empty_batch(tokenizer):
+    assert tokenizer.encode_batch_to_ids([]) == []
+    assert tokenizer.batch_tokenize(["12,345"]) == [tokenizer.tokenize("12,345")]
+
+
+def _copy(model_dir, tmp_path):
+    copy_dir = tmp_path / "kobert"
+    copy_dir.mkdir()
+    for name in VOCAB_FILES_NAMES.values():
+        shutil.copy(str(model_dir / name), str(copy_dir / name))
+    return copy_dir
+
+
+def test_vocab_cache_written_and_reused(model_dir, tmp_path, corpus):
+    copy_dir = _copy(model_dir, tmp_path)
+    cache_file = copy_dir / (VOCAB_FILES_NAMES["vocab_txt"] + ".cache.npz")
+    first = _load(copy_dir)
+    assert cache_file.is_file()
+    mtime = cache_file.stat().st_mtime_ns
+    second = _load(copy_dir)
+    assert cache_file.stat().st_mtime_ns == mtime
+    texts = _texts(corpus)
+    assert second.encode_batch_to_ids(texts) == first.encode_batch_to_ids(texts)
+
+
+def test_vocab_cache_rebuilt_when_size_changes(model_dir, tmp_path, corpus):
+    copy_dir = _copy(model_dir, tmp_path)
+    _load(copy_dir)
+    vocab_txt = copy_dir / VOCAB_FILES_NAMES["vocab_txt"]
+    with open(str(vocab_txt), "a", encoding="utf-8") as f:
+        f.write("[NEW]\n")
+
+    tokenizer = _load(copy_dir)
+    assert tokenizer.idx2token[-1] == "[NEW]"
+    texts = _texts(corpus)
+    expected = [tokenizer.convert_tokens_to_ids(tokens) for tokens in _reference(tokenizer, texts)]
+    assert tokenizer.encode_batch_to_ids(texts) == expected
+
+
+def test_vocab_cache_rebuilt_when_mtime_changes(model_dir, tmp_path, corpus):
+    copy_dir = _copy(model_dir, tmp_path)
+    _load(copy_dir)
+    vocab_txt = copy_dir / VOCAB_FILES_NAMES["vocab_txt"]
+    # Same size, other order: only the mtime tells the cache apart
+    lines = vocab_txt.read_text(encoding="utf-8").splitlines()
+    lines[10], lines[11] = lines[11], lines[10]
+    stat = vocab_txt.stat()
+    vocab_txt.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    os.utime(str(vocab_txt), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert vocab_txt.stat().st_size == stat.st_size
+
+    tokenizer = _load(copy_dir)
+    assert tokenizer.idx2token[10] == lines[10] and tokenizer.token2idx[lines[11]] == 11
+    texts = _texts(corpus)
+    expected = [tokenizer.convert_tokens_to_ids(tokens) for tokens in _reference(tokenizer, texts)]
+    assert tokenizer.encode_batch_to_ids(texts) == expected
@@ -1,26 +1,32 @@
-import torch
 import time
 import sys
 
-from data_loader import load_and_cache_examples
 from utils import init_logger, load_tokenizer, set_seed, MODEL_CLASSES, MODEL_PATH_MAP
-from trainer import Trainer
 
 import pdb
 
 print_w_time = lambda elapsed: print("\t완료 ({}초 소요)".format(elapsed))
 
 def train(args):
+    # torch and the model classes are only imported once the arguments are validated
+    from distributed import init_distributed
+    from data_loader import load_and_cache_examples
+    from trainer import Trainer
+
+    # Data-parallel when launched with torchrun (e.g. torchrun --nproc_per_node=4 timex3.py train kobert)
+    init_distributed(args["ddp_backend"])
+    set_seed(args)
+
     print("> train_dataset 데이터 로딩: ", end="")
     start = time.time()
     args["data_dir"] = data_path + 'Train/AI모델링/'
-    train_dataset = load_and_cache_examples(args, tokenizer, mode="train", use_cache=False)
+    train_dataset = load_and_cache_examples(args, tokenizer, mode="train")
     print_w_time(time.time() - start)
 
     print("> dev_dataset 데이터 로딩: ", end="")
     start = time.time()
     args["data_dir"] = data_path + 'Validation/AI모델링/'
-    dev_dataset = load_and_cache_examples(args, tokenizer, mode="dev", use_cache=False)
+    dev_dataset = load_and_cache_examples(args, tokenizer, mode="dev")
     print_w_time(time.time() - start)
     
     print("> 학습객체 trainer 생성: ", end="")
@@ -40,6 +46,10 @@ def train(args):
 
 
 def test(args):
+    # torch and the model classes are only imported once the arguments are validated
+    from data_loader import load_and_cache_examples
+    from trainer import Trainer
+
     print("> argument")
     print(args)
     print()
@@ -47,7 +57,7 @@ def test(args):
     print("> test_dataset 데이터 로딩: ", end="")
     start = time.time()
     args["data_dir"] = data_path + 'Test/AI모델링/'
-    test_dataset = load_and_cache_examples(args, tokenizer, mode="test", use_cache=False)
+    test_dataset = load_and_cache_examples(args, tokenizer, mode="test")
     print_w_time(time.time() - start)
     
     print("> 학습된 모델 불러오기(trainer.load_model): ", end="")
@@ -64,7 +74,7 @@ def test(args):
 
 if __name__ == '__main__':
     if len(sys.argv) < 3:
-        print("Usage:  $ python3 timex3.py train|test kobert|koelectra")
+        print("Usage:  $ python3 timex3.py train|test kobert|koelectra [--resume]")
         exit()
     run_mode = sys.argv[1]
     model_type = sys.argv[2]
@@ -93,6 +103,11 @@ if __name__ == '__main__':
         "train_batch_size":64,
         "eval_batch_size": 64,
         "max_seq_len": 100,
+        "token_cache_size": 65536,
+        "feature_chunk_size": 10000,
+        "featurize_workers": 0,  # 0: one process per CPU core
+        "mixed_precision": "no",  # no, bf16 (CPU or GPU) or fp16 (GPU, with loss scaling)
+        "ddp_backend": "gloo",  # Process group backend under torchrun: gloo (CPU hosts) or nccl
         "learning_rate": 5e-5,
         "num_train_epochs": 40.0,
         "weight_decay": 0.0,
@@ -104,6 +119,11 @@ if __name__ == '__main__':
         "warmup_steps": 0,
         "logging_steps": 1000,
         "save_steps": 1000,
+        "checkpoint_steps": 1000,  # Full training state (optimizer, scheduler, RNG) to resume from; 0: off
+        "keep_checkpoints": 2,  # Only the most recent checkpoints are kept; 0: all
+        "resume": False,  # Continue from the latest checkpoint in model_dir/checkpoints
+        "profile_file": None,  # e.g. ./profile_timex3.csv or .jsonl: per-step timings and throughput
+        "torch_profile_steps": None,  # e.g. (100, 105): torch.profiler trace of these optimization steps
         "do_train": False,
         "do_eval": False,
         "no_cuda": False
@@ -117,6 +137,7 @@ if __name__ == '__main__':
 
     if run_mode == 'train':
         args["do_train"] = True
+        args["resume"] = "--resume" in sys.argv[3:]
         args["pred_dir"] = "./validation_timex3_{}".format(model_type)
         train(args)
     elif run_mode == 'test':
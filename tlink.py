@@ -1,32 +1,38 @@
-import torch
 import time
 import sys
 
-from data_loader_tlink import load_and_cache_examples
 from utils import init_logger, load_tokenizer, set_seed, MODEL_CLASSES, MODEL_PATH_MAP
-from trainer_tlink import Trainer
 
 import pdb
 
 print_w_time = lambda elapsed: print("\t완료 ({}초 소요)".format(elapsed))
 
 def train(args):
+    # torch and the model classes are only imported once the arguments are validated
+    from distributed import init_distributed
+    from data_loader_tlink import load_and_cache_examples
+    from trainer_tlink import Trainer
+
+    # Data-parallel when launched with torchrun (e.g. torchrun --nproc_per_node=4 tlink.py train kobert)
+    init_distributed(args["ddp_backend"])
+    set_seed(args)
+
     print("> train_dataset 데이터 로딩: ", end="")
     start = time.time()
     args["data_dir"] = data_path + 'Train/AI모델링/'
     if args['class_weights']:
         args['model_dir'] += '_cw'
-        train_dataset, class_weights = load_and_cache_examples(args, tokenizer, mode="train", use_cache=False, compute_class_weight=True)
+        train_dataset, class_weights = load_and_cache_examples(args, tokenizer, mode="train", compute_class_weight=True)
         print("class_weights: {}".format(class_weights))
     else:
-        train_dataset = load_and_cache_examples(args, tokenizer, mode="train", use_cache=False, compute_class_weight=False)
+        train_dataset = load_and_cache_examples(args, tokenizer, mode="train", compute_class_weight=False)
         class_weights = None
     print_w_time(time.time() - start)
     
     print("> dev_dataset 데이터 로딩: ", end="")
     start = time.time()
     args["data_dir"] = data_path + 'Validation/AI모델링/'
-    dev_dataset = load_and_cache_examples(args, tokenizer, mode="dev", use_cache=False)
+    dev_dataset = load_and_cache_examples(args, tokenizer, mode="dev")
     print_w_time(time.time() - start)
     
     print("> 학습객체 trainer 생성: ", end="")
@@ -45,6 +51,10 @@ def train(args):
     print_w_time(time.time() - start)
 
 def test(args):
+    # torch and the model classes are only imported once the arguments are validated
+    from data_loader_tlink import load_and_cache_examples
+    from trainer_tlink import Trainer
+
     print("> argument")
     print(args)
     print()
@@ -52,7 +62,7 @@ def test(args):
     print("> test_dataset 데이터 로딩: ", end="")
     start = time.time()
     args["data_dir"] = data_path + 'Test/AI모델링/'
-    test_dataset = load_and_cache_examples(args, tokenizer, mode="test", use_cache=False)
+    test_dataset = load_and_cache_examples(args, tokenizer, mode="test")
     print_w_time(time.time() - start)
     
     if args['class_weights']:
@@ -72,7 +82,7 @@ def test(args):
 
 if __name__ == '__main__':
     if len(sys.argv) < 3:
-        print("Usage:  $ python3 tlink.py train|test kobert|koelectra")
+        print("Usage:  $ python3 tlink.py train|test kobert|koelectra [--entity-marker] [--resume]")
         exit()
     run_mode = sys.argv[1]
     model_type = sys.argv[2]
@@ -87,6 +97,9 @@ if __name__ == '__main__':
         model_type += '-base'
 
     model_type += '-tlink'
+    if "--entity-marker" in sys.argv[3:]:
+        # Classify from the [B1]/[B2] marker states instead of [CLS]
+        model_type += '-em'
 
     data_path = './data_path/'
     args = {
@@ -103,6 +116,11 @@ if __name__ == '__main__':
         "train_batch_size":64,
         "eval_batch_size": 64,
         "max_seq_len": 100,
+        "token_cache_size": 65536,
+        "feature_chunk_size": 10000,
+        "featurize_workers": 0,  # 0: one process per CPU core
+        "mixed_precision": "no",  # no, bf16 (CPU or GPU) or fp16 (GPU, with loss scaling)
+        "ddp_backend": "gloo",  # Process group backend under torchrun: gloo (CPU hosts) or nccl
         "learning_rate": 5e-5,
         "num_train_epochs": 40.0,
         "weight_decay": 0.0,
@@ -115,6 +133,11 @@ if __name__ == '__main__':
         "class_weights": False,
         "logging_steps": 1000,
         "save_steps": 1000,
+        "checkpoint_steps": 1000,  # Full training state (optimizer, scheduler, RNG) to resume from; 0: off
+        "keep_checkpoints": 2,  # Only the most recent checkpoints are kept; 0: all
+        "resume": False,  # Continue from the latest checkpoint in model_dir/checkpoints
+        "profile_file": None,  # e.g. ./profile_tlink.csv or .jsonl: per-step timings and throughput
+        "torch_profile_steps": None,  # e.g. (100, 105): torch.profiler trace of these optimization steps
         "do_train": False,
         "do_eval": False,
         "no_cuda": False
@@ -130,6 +153,7 @@ if __name__ == '__main__':
 
     if run_mode == 'train':
         args["do_train"] = True
+        args["resume"] = "--resume" in sys.argv[3:]
         args["pred_dir"] = "./validation_tlink_{}".format(model_type)
         train(args)
     elif run_mode == 'test':
@@ -0,0 +1,135 @@
+import logging
+import weakref
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+SPIECE_UNDERLINE = u'▁'
+WORDPIECE_PREFIX = '##'
+
+DEFAULT_CACHE_SIZE = 65536
+
+
+class TokenCache(object):
+    """
+    Bounded (LRU) memo of word -> token ids for one tokenizer.
+    The NER loaders tokenize one character at a time, so a few thousand distinct
+    Hangul syllables cover almost every lookup.
+    Args:
+        tokenizer: Tokenizer whose `tokenize` + `convert_tokens_to_ids` results are memoized.
+        max_size: Maximum number of distinct words to keep. The least recently used ones are evicted.
+    """
+
+    def __init__(self, tokenizer, max_size=DEFAULT_CACHE_SIZE):
+        self.tokenizer = tokenizer
+        self.max_size = max_size
+        self.vocab_len = len(tokenizer)
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, word):
+        return word in self._cache
+
+    def _encode(self, word):
+        tokens = self.tokenizer.tokenize(word)
+        if not tokens:
+            tokens = [self.tokenizer.unk_token]  # For handling the bad-encoded word
+        return tuple(self.tokenizer.convert_tokens_to_ids(tokens))
+
+    def _store(self, word, entry):
+        self._cache[word] = entry
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def lookup(self, word):
+        """Returns the tuple of token ids of `word`, tokenizing it only on a miss."""
+        entry = self._cache.get(word)
+        if entry is not None:
+            self.hits += 1
+            self._cache.move_to_end(word)
+            return entry
+        self.misses += 1
+        entry = self._encode(word)
+        self._store(word, entry)
+        return entry
+
+    def prefetch(self, words):
+        """
+        Encodes the words that are not cached yet straight to ids in one batch call, if the tokenizer
+        has an `encode_batch_to_ids` method (KoBertTokenizer). Prefetched words count as neither hits nor misses.
+        Returns:
+            The number of newly cached words.
+        """
+        encode_batch_to_ids = getattr(self.tokenizer, "encode_batch_to_ids", None)
+        if encode_batch_to_ids is None:
+            return 0
+        missing = [word for word in dict.fromkeys(words) if word not in self._cache][:self.max_size]
+        if not missing:
+            return 0
+        unk_ids = (self.tokenizer.unk_token_id,)  # For handling the bad-encoded word, as in `_encode`
+        for word, ids in zip(missing, encode_batch_to_ids(missing)):
+            self._store(word, tuple(ids) or unk_ids)
+        self.prefetched += len(missing)
+        return len(missing)
+
+    def warm_from_vocab(self):
+        """
+        Pre-populates the cache with every single-character entry of the tokenizer vocab
+        (`▁가` for SentencePiece, `##가` for WordPiece). Warming does not count towards the hit rate.
+        Returns:
+            The number of newly cached words.
+        """
+        added = 0
+        for token in self.tokenizer.get_vocab():
+            word = token.replace(SPIECE_UNDERLINE, "")
+            if word.startswith(WORDPIECE_PREFIX):
+                word = word[len(WORDPIECE_PREFIX):]
+            if len(word) != 1 or word.isspace() or word in self._cache:
+                continue
+            if len(self._cache) >= self.max_size:
+                break
+            self._store(word, self._encode(word))
+            added += 1
+        logger.info("Warmed token cache with %d words from the vocab", added)
+        return added
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            "size": len(self._cache),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "prefetched": self.prefetched,
+            "hit_rate": self.hit_rate
+        }
+
+    def log_stats(self):
+        logger.info("Token cache: %d/%d words, %d hits, %d misses, %d prefetched (hit rate %.4f)",
+                    len(self._cache), self.max_size, self.hits, self.misses, self.prefetched, self.hit_rate)
+
+
+_token_caches = weakref.WeakKeyDictionary()
+
+
+def get_token_cache(tokenizer, max_size=DEFAULT_CACHE_SIZE, warm=False):
+    """
+    Returns the process-wide TokenCache of `tokenizer`, creating it on first use.
+    The cache is rebuilt if tokens were added to the tokenizer since it was created (e.g. the TLINK markers).
+    """
+    cache = _token_caches.get(tokenizer)
+    if cache is None or cache.vocab_len != len(tokenizer) or cache.max_size != max_size:
+        cache = TokenCache(tokenizer, max_size=max_size)
+        _token_caches[tokenizer] = cache
+        if warm:
+            cache.warm_from_vocab()
+    return cache
@@ -1,8 +1,11 @@
 import logging
 import os
+import itertools
+import tempfile
 import unicodedata
 from shutil import copyfile
 
+import numpy as np
 from transformers import PreTrainedTokenizer
 
 
@@ -38,6 +41,86 @@ PRETRAINED_INIT_CONFIGURATION = {
 
 SPIECE_UNDERLINE = u'▁'
 
+# Bump whenever the layout of the on-disk vocab cache changes
+VOCAB_CACHE_VERSION = 1
+
+_vocab_caches = dict()
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return [os.path.abspath(path), str(stat.st_size), str(stat.st_mtime_ns)]
+
+
+def _build_vocab(vocab_txt, sp_model):
+    idx2token = []
+    token2idx = dict()
+    with open(vocab_txt, 'r', encoding='utf-8') as f:
+        for idx, token in enumerate(f):
+            token = token.strip()
+            token2idx[token] = idx
+            idx2token.append(token)
+    pieces = [sp_model.IdToPiece(i) for i in range(sp_model.GetPieceSize())]
+    sp_to_vocab = np.array([token2idx.get(piece, -1) for piece in pieces], dtype=np.int64)
+    # Pieces whose id alone does not give the model ids: the digit-comma rule of `_split_digit_comma`
+    # re-splits them, and unknown pieces are looked up by their surface string
+    sp_needs_pieces = np.array([(len(piece) > 1 and piece[-1] == "," and piece[-2].isdigit()) or sp_model.IsUnknown(i)
+                                for i, piece in enumerate(pieces)], dtype=bool)
+    return idx2token, sp_to_vocab, sp_needs_pieces
+
+
+def _write_vocab_cache(cache_file, signature, idx2token, sp_to_vocab, sp_needs_pieces):
+    try:
+        fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(cache_file) + ".", suffix=".tmp",
+                                        dir=os.path.dirname(cache_file) or ".")
+    except OSError:
+        logger.info("Could not write the vocab cache %s", cache_file)
+        return
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, signature=np.array(signature), idx2token=np.array(idx2token), sp_to_vocab=sp_to_vocab,
+                     sp_needs_pieces=sp_needs_pieces)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        logger.info("Could not write the vocab cache %s", cache_file)
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def load_vocab(vocab_file, vocab_txt, sp_model):
+    """
+    Reads vocab.txt and maps every SentencePiece id to its vocab.txt id (-1 for pieces missing from
+    vocab.txt). The result is cached in this process, and on disk next to vocab.txt (`vocab.txt.cache.npz`,
+    keyed on the size and mtime of both vocab files) so that later launches skip parsing and mapping.
+    Returns:
+        (token2idx, idx2token, sp_to_vocab, sp_needs_pieces), the last two being arrays indexed by SentencePiece id
+    """
+    signature = _file_signature(vocab_txt) + _file_signature(vocab_file) + [str(VOCAB_CACHE_VERSION)]
+    key = tuple(signature)
+    if key in _vocab_caches:
+        return _vocab_caches[key]
+
+    cache_file = vocab_txt + ".cache.npz"
+    idx2token = None
+    if os.path.isfile(cache_file):
+        try:
+            with np.load(cache_file) as cache:
+                if cache["signature"].tolist() == signature:
+                    idx2token = cache["idx2token"].tolist()
+                    sp_to_vocab = cache["sp_to_vocab"]
+                    sp_needs_pieces = cache["sp_needs_pieces"]
+        except (OSError, ValueError, KeyError):
+            logger.warning("Ignoring unreadable vocab cache %s", cache_file)
+    if idx2token is None:
+        idx2token, sp_to_vocab, sp_needs_pieces = _build_vocab(vocab_txt, sp_model)
+        _write_vocab_cache(cache_file, signature, idx2token, sp_to_vocab, sp_needs_pieces)
+
+    token2idx = dict()
+    for idx, token in enumerate(idx2token):
+        token2idx[token] = idx
+    _vocab_caches[key] = token2idx, idx2token, sp_to_vocab, sp_needs_pieces
+    return _vocab_caches[key]
+
 
 class KoBertTokenizer(PreTrainedTokenizer):
     """
@@ -71,15 +154,6 @@ class KoBertTokenizer(PreTrainedTokenizer):
             **kwargs
         )
 
-        # Build vocab
-        self.token2idx = dict()
-        self.idx2token = []
-        with open(vocab_txt, 'r', encoding='utf-8') as f:
-            for idx, token in enumerate(f):
-                token = token.strip()
-                self.token2idx[token] = idx
-                self.idx2token.append(token)
-
         try:
             import sentencepiece as spm
         except ImportError:
@@ -95,6 +169,15 @@ class KoBertTokenizer(PreTrainedTokenizer):
         self.sp_model = spm.SentencePieceProcessor()
         self.sp_model.Load(vocab_file)
 
+        # Build vocab (cached in-process and on disk, see `load_vocab`)
+        self.token2idx, self.idx2token, self._sp_to_vocab, self._sp_needs_pieces = load_vocab(
+            vocab_file, vocab_txt, self.sp_model)
+        self._sp_to_ids_cache = None
+
+        # Per-character result of NFKD + dropping combining marks, filled lazily by the batch path
+        self._char_map = dict()
+        self._char_map_seen = set()
+
     @property
     def vocab_size(self):
         return len(self.idx2token)
@@ -133,14 +216,26 @@ class KoBertTokenizer(PreTrainedTokenizer):
 
         return outputs
 
-    def _tokenize(self, text, return_unicode=True, sample=False):
-        """ Tokenize a string. """
-        text = self.preprocess_text(text)
-
-        if not sample:
-            pieces = self.sp_model.EncodeAsPieces(text)
-        else:
-            pieces = self.sp_model.SampleEncodeAsPieces(text, 64, 0.1)
+    def _preprocess_text_fast(self, inputs):
+        """
+        Same output as `preprocess_text` when `remove_space` is set and `do_lower_case` is not.
+        Every character is then separated by a space, so the `` and '' replacements never match, and
+        NFKD followed by dropping combining marks acts on each character independently (canonical
+        reordering only moves combining marks, which are dropped). The per-character result is
+        memoized and applied with `str.translate`; ASCII input is left as is.
+        """
+        outputs = " ".join(inputs.strip())
+        if self.keep_accents or outputs.isascii():
+            return outputs
+        for c in set(outputs).difference(self._char_map_seen):
+            normalized = "".join([n for n in unicodedata.normalize('NFKD', c) if not unicodedata.combining(n)])
+            if normalized != c:
+                self._char_map[ord(c)] = normalized
+            self._char_map_seen.add(c)
+        return outputs.translate(self._char_map)
+
+    def _split_digit_comma(self, pieces):
+        """Splits pieces like `▁1,` into `▁1` and `,`."""
         new_pieces = []
         for piece in pieces:
             if len(piece) > 1 and piece[-1] == str(",") and piece[-2].isdigit():
@@ -157,6 +252,87 @@ class KoBertTokenizer(PreTrainedTokenizer):
 
         return new_pieces
 
+    def _tokenize(self, text, return_unicode=True, sample=False):
+        """ Tokenize a string. """
+        text = self.preprocess_text(text)
+
+        if not sample:
+            pieces = self.sp_model.EncodeAsPieces(text)
+        else:
+            pieces = self.sp_model.SampleEncodeAsPieces(text, 64, 0.1)
+        return self._split_digit_comma(pieces)
+
+    def _partition_batch(self, texts):
+        """Splits texts into those the batch path can encode (preprocessed) and those that need `tokenize`."""
+        fast_index, fast_texts, slow_index = [], [], []
+        fast = self.remove_space and not self.do_lower_case
+        no_split_tokens = self.unique_no_split_tokens
+        for i, text in enumerate(texts):
+            if fast and not any(token in text for token in no_split_tokens):
+                fast_index.append(i)
+                fast_texts.append(self._preprocess_text_fast(text))
+            else:
+                slow_index.append(i)
+        return fast_index, fast_texts, slow_index
+
+    def batch_tokenize(self, texts):
+        """
+        Tokenizes many texts at once, with the same output as `[self.tokenize(text) for text in texts]`.
+        Texts without added/special tokens are normalized with the memoized per-character table and
+        encoded by SentencePiece in one batch call; the others go through `tokenize`.
+        """
+        results = [None] * len(texts)
+        fast_index, fast_texts, slow_index = self._partition_batch(texts)
+        for i in slow_index:
+            results[i] = self.tokenize(texts[i])
+        if fast_texts:
+            for i, pieces in zip(fast_index, self.sp_model.encode(fast_texts, out_type=str)):
+                results[i] = self._split_digit_comma(pieces)
+        return results
+
+    def sp_to_ids(self):
+        """
+        SentencePiece id -> model id remap array, with pieces missing from vocab.txt mapped to unk and
+        added tokens that are also SentencePiece pieces mapped to their added id, as `convert_tokens_to_ids` does.
+        Rebuilt when tokens are added.
+        """
+        key = (self.unk_token, tuple(sorted(self.added_tokens_encoder.items())))
+        if self._sp_to_ids_cache is None or self._sp_to_ids_cache[0] != key:
+            sp_to_ids = np.where(self._sp_to_vocab < 0, self.token2idx[self.unk_token], self._sp_to_vocab)
+            for token, token_id in self.added_tokens_encoder.items():
+                piece_id = self.sp_model.PieceToId(token)
+                if self.sp_model.IdToPiece(piece_id) == token:
+                    sp_to_ids[piece_id] = token_id
+            self._sp_to_ids_cache = (key, sp_to_ids)
+        return self._sp_to_ids_cache[1]
+
+    def encode_batch_to_ids(self, texts):
+        """
+        Encodes many texts straight to ids (without [CLS]/[SEP]), with the same output as
+        `[self.convert_tokens_to_ids(self.tokenize(text)) for text in texts]`.
+        The SentencePiece ids of the whole batch are mapped to model ids with one gather through `sp_to_ids`;
+        only sentences with a piece that needs the string path (digit-comma rule, unknown piece) are redone.
+        """
+        results = [None] * len(texts)
+        fast_index, fast_texts, slow_index = self._partition_batch(texts)
+        for i in slow_index:
+            results[i] = self.convert_tokens_to_ids(self.tokenize(texts[i]))
+        if not fast_texts:
+            return results
+
+        batch_sp_ids = self.sp_model.encode(fast_texts)
+        lengths = np.array([len(sp_ids) for sp_ids in batch_sp_ids], dtype=np.int64)
+        flat_sp_ids = np.fromiter(itertools.chain.from_iterable(batch_sp_ids), dtype=np.int64, count=int(lengths.sum()))
+        flat_ids = self.sp_to_ids()[flat_sp_ids]
+        needs_pieces = np.bincount(np.repeat(np.arange(len(lengths)), lengths),
+                                   weights=self._sp_needs_pieces[flat_sp_ids], minlength=len(lengths)) > 0
+        for i, text, ids, redo in zip(fast_index, fast_texts, np.split(flat_ids, np.cumsum(lengths)[:-1]), needs_pieces):
+            if redo:
+                results[i] = self.convert_tokens_to_ids(self._split_digit_comma(self.sp_model.EncodeAsPieces(text)))
+            else:
+                results[i] = ids.tolist()
+        return results
+
     def _convert_token_to_id(self, token):
         """ Converts a token (str/unicode) in an id using the vocab. """
         return self.token2idx.get(token, self.token2idx[self.unk_token])
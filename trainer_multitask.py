@@ -0,0 +1,349 @@
+import os
+import logging
+from tqdm import tqdm, trange
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
+
+from batching import LengthBucketSampler
+from checkpoint import AsyncCheckpointWriter, snapshot_to_cpu
+from distributed import is_distributed, is_main_process, get_rank, get_world_size, get_local_rank, all_reduce_sum
+from mixed_precision import MixedPrecision
+from metrics import SpanMetric, ConfusionMatrix
+from label_vocab import get_label_vocab
+from modeling_multitask import MultiTaskModel
+from utils import MODEL_CLASSES
+
+logger = logging.getLogger(__name__)
+
+SEQUENCE_TASKS = ("tlink",)
+
+
+def get_task_args(args, task):
+    """The args of one task: the shared args with the task's own files and data task (args["tasks"][task])."""
+    task_args = dict(args)
+    task_args.update(args["tasks"][task])
+    return task_args
+
+
+def task_schedule(num_batches, seed):
+    """
+    Interleaves the batches of the tasks: every task appears once per batch, in a shuffled order, so
+    the tasks are sampled in proportion to their dataset sizes over an epoch.
+    Args:
+        num_batches: dict of task name to its number of batches.
+    Returns:
+        List of task names, one per training step
+    """
+    schedule = np.concatenate([np.full(n, i, dtype=np.int64) for i, n in enumerate(num_batches.values())])
+    np.random.RandomState(seed).shuffle(schedule)
+    tasks = list(num_batches)
+    return [tasks[i] for i in schedule]
+
+
+class MultiTaskTrainer(object):
+    """
+    Trains a MultiTaskModel (one shared encoder, event/timex3/TLINK heads) on the interleaved batches
+    of the three datasets; the shared args hold one dict of files per task in args["tasks"].
+    Args:
+        train_datasets, dev_datasets, test_datasets: dicts of task name to FeatureDataset.
+        tokenizer: Tokenizer with the TLINK markers added (the embeddings are resized to it).
+        class_weights: Optional TLINK class weights.
+    """
+
+    def __init__(self, args, train_datasets=None, dev_datasets=None, test_datasets=None, tokenizer=None, class_weights=None):
+        self.args = args
+        self.train_datasets = train_datasets
+        self.dev_datasets = dev_datasets
+        self.test_datasets = test_datasets
+        self.tasks = list(args["tasks"])
+
+        self.label_vocabs = {task: get_label_vocab(get_task_args(args, task)) for task in self.tasks}
+        self.span_metrics = {task: SpanMetric(self.label_vocabs[task], suffix=True)
+                             for task in self.tasks if task not in SEQUENCE_TASKS}
+        self.pad_token_label_id = torch.nn.CrossEntropyLoss().ignore_index
+
+        _, self.encoder_class, _ = MODEL_CLASSES[args["model_type"]]
+        encoder = self.encoder_class.from_pretrained(args["model_name_or_path"])
+        if tokenizer:
+            encoder.resize_token_embeddings(len(tokenizer))
+        self.model = MultiTaskModel(encoder, {task: self.label_vocabs[task].labels for task in self.tasks}, SEQUENCE_TASKS)
+
+        # GPU or CPU; one GPU per process when distributed (torchrun)
+        self.rank, self.world_size = get_rank(), get_world_size()
+        if torch.cuda.is_available() and not args["no_cuda"]:
+            self.device = "cuda:{}".format(get_local_rank()) if is_distributed() else "cuda"
+        else:
+            self.device = "cpu"
+        self.model.to(self.device)
+        self.precision = MixedPrecision(args["mixed_precision"], torch.device(self.device).type)
+        self.checkpoint_writer = AsyncCheckpointWriter()
+
+        self.class_weights = None
+        if class_weights is not None:
+            self.class_weights = torch.Tensor(class_weights).to(self.device)
+
+    def _inputs(self, task, batch):
+        inputs = {'input_ids': batch[0],
+                  'attention_mask': batch[1],
+                  'token_type_ids': batch[2],
+                  'labels': batch[3]}
+        if task in SEQUENCE_TASKS:
+            inputs['class_weights'] = self.class_weights
+        return inputs
+
+    def train(self):
+        from transformers import AdamW, get_linear_schedule_with_warmup
+
+        train_samplers = {task: LengthBucketSampler(self.train_datasets[task].lengths, self.args["train_batch_size"],
+                                                    shuffle=True, seed=self.args["seed"],
+                                                    num_replicas=self.world_size, rank=self.rank)
+                          for task in self.tasks}
+        steps_per_epoch = sum(len(sampler) for sampler in train_samplers.values())
+
+        if self.args["max_steps"] > 0:
+            t_total = self.args["max_steps"]
+            self.args["num_train_epochs"] = self.args["max_steps"] // (steps_per_epoch // self.args["gradient_accumulation_steps"]) + 1
+        else:
+            t_total = steps_per_epoch // self.args["gradient_accumulation_steps"] * self.args["num_train_epochs"]
+
+        if is_distributed():
+            # Every step trains one head only, so the others get no gradient in that step
+            self.model = DistributedDataParallel(self.model, device_ids=None if self.device == "cpu" else [get_local_rank()],
+                                                 find_unused_parameters=True)
+
+        # Prepare optimizer and schedule (linear warmup and decay)
+        no_decay = ['bias', 'LayerNorm.weight']
+        optimizer_grouped_parameters = [
+            {'params': [p for n, p in self.model.named_parameters() if not any(nd in n for nd in no_decay)],
+             'weight_decay': self.args["weight_decay"]},
+            {'params': [p for n, p in self.model.named_parameters() if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
+        ]
+        optimizer = AdamW(optimizer_grouped_parameters, lr=self.args["learning_rate"], eps=self.args["adam_epsilon"])
+        scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps=self.args["warmup_steps"], num_training_steps=t_total)
+
+        logger.info("***** Running multi-task training *****")
+        for task in self.tasks:
+            logger.info("  Num %s examples = %d (%d batches)", task, len(self.train_datasets[task]), len(train_samplers[task]))
+        logger.info("  Num Epochs = %d", self.args["num_train_epochs"])
+        logger.info("  Num processes = %d", self.world_size)
+        logger.info("  Gradient Accumulation steps = %d", self.args["gradient_accumulation_steps"])
+        logger.info("  Total optimization steps = %d", t_total)
+        logger.info("  Logging steps = %d", self.args["logging_steps"])
+        logger.info("  Patience = %d", self.args["patience"])
+        logger.info("  Save steps = %d", self.args["save_steps"])
+
+        global_step = 0
+        tr_loss = 0.0
+        self.model.zero_grad()
+
+        train_iterator = trange(int(self.args["num_train_epochs"]), desc="Epoch", disable=not is_main_process())
+
+        to_stop = False
+        trigger_times = 0
+        last_loss = None
+        patience = self.args["patience"]
+        for ei in train_iterator:
+            if is_main_process():
+                print('[Epoch] {}/{}'.format(ei+1, self.args["num_train_epochs"]))
+            batch_iterators = {}
+            for task, sampler in train_samplers.items():
+                sampler.set_epoch(ei)
+                dataset = self.train_datasets[task]
+                batch_iterators[task] = iter(DataLoader(dataset, batch_sampler=sampler, collate_fn=dataset.collate,
+                                                        generator=torch.Generator().manual_seed(self.args["seed"])))
+            # The same schedule on every process, so that they train the same head at each step
+            schedule = task_schedule({task: len(sampler) for task, sampler in train_samplers.items()}, self.args["seed"] + ei)
+
+            epoch_iterator = tqdm(schedule, desc="Iteration", disable=not is_main_process())
+            for step, task in enumerate(epoch_iterator):
+                self.model.train()
+                batch = tuple(t.to(self.device) for t in next(batch_iterators[task]))  # GPU or CPU
+                # Only all-reduce the gradients on the last micro-batch of an accumulation window
+                accumulating = (step + 1) % self.args["gradient_accumulation_steps"] != 0
+                with self.model.no_sync() if is_distributed() and accumulating else nullcontext():
+                    with self.precision.autocast():
+                        outputs = self.model(task, **self._inputs(task, batch))
+                    loss = outputs[0]
+
+                    if self.args["gradient_accumulation_steps"] > 1:
+                        loss = loss / self.args["gradient_accumulation_steps"]
+
+                    self.precision.backward(loss)
+
+                tr_loss += loss.item()
+                if (step + 1) % self.args["gradient_accumulation_steps"] == 0:
+                    self.precision.step(optimizer, self.model.parameters(), self.args["max_grad_norm"])
+                    scheduler.step()  # Update learning rate schedule
+                    self.model.zero_grad()
+                    global_step += 1
+
+                    if self.args["logging_steps"] > 0 and global_step % self.args["logging_steps"] == 0:
+                        eval_results = self.evaluate("dev", global_step)
+                        eval_loss = eval_results["loss"]
+                        if last_loss == None or eval_loss > last_loss:
+                            trigger_times += 1
+                        last_loss = eval_loss
+                        if is_main_process():
+                            print("model checked with dev dataset (eval loss: {}, #trigger: {}/{})".format(eval_loss, trigger_times, patience))
+                        if patience > 0 and trigger_times >= patience:
+                            if is_main_process():
+                                print("Early stopped!")
+                            to_stop = True
+
+                    if self.args["save_steps"] > 0 and global_step % self.args["save_steps"] == 0:
+                        self.save_model(wait=False)
+                        if is_main_process():
+                            print("model saving in the background.")
+
+                if to_stop:
+                    break
+
+                if 0 < self.args["max_steps"] < global_step:
+                    epoch_iterator.close()
+                    break
+
+            if to_stop or (0 < self.args["max_steps"] < global_step):
+                train_iterator.close()
+                break
+
+        self.checkpoint_writer.wait()
+        return global_step, tr_loss / global_step
+
+    def _evaluate_task(self, task, dataset, model):
+        """
+        Returns:
+            (mean batch loss, scores, SpanScores or ConfusionMatrix)
+        """
+        token_level = task not in SEQUENCE_TASKS
+        # Batches are sorted by length; eval_order maps them back to the dataset order.
+        # When distributed, each process evaluates every world_size-th batch and the results are summed up.
+        eval_batches = LengthBucketSampler(dataset.lengths, self.args["eval_batch_size"], shuffle=False).batches()
+        eval_batches = eval_batches[self.rank::self.world_size]
+        eval_dataloader = DataLoader(dataset, batch_sampler=eval_batches, collate_fn=dataset.collate)
+        eval_order = np.concatenate(eval_batches) if eval_batches else np.zeros(0, dtype=np.int64)
+
+        if token_level:
+            max_len = int(dataset.lengths.max())
+            preds = np.zeros((len(dataset), max_len), dtype=np.int64)
+            out_label_ids = np.full((len(dataset), max_len), self.pad_token_label_id, dtype=np.int64)
+        else:
+            preds = np.zeros(len(dataset), dtype=np.int64)
+            out_label_ids = np.zeros(len(dataset), dtype=np.int64)
+        eval_loss = 0.0
+        nb_eval_steps = 0
+        num_seen = 0
+
+        for batch in tqdm(eval_dataloader, desc="Evaluating {}".format(task), disable=not is_main_process()):
+            batch = tuple(t.to(self.device) for t in batch)
+            with torch.no_grad(), self.precision.autocast():
+                tmp_eval_loss, logits = model(task, **self._inputs(task, batch))
+            eval_loss += tmp_eval_loss.item()
+            nb_eval_steps += 1
+
+            batch_index = eval_order[num_seen:num_seen + logits.shape[0]]
+            if token_level:
+                preds[batch_index, :logits.shape[1]] = logits.argmax(dim=-1).cpu().numpy()
+                out_label_ids[batch_index, :logits.shape[1]] = batch[3].cpu().numpy()
+            else:
+                preds[batch_index] = logits.argmax(dim=-1).cpu().numpy()
+                out_label_ids[batch_index] = batch[3].cpu().numpy()
+            num_seen += logits.shape[0]
+
+        if is_distributed():
+            # Every process filled only the rows of its own batches; zero the rest and sum over the processes
+            not_evaluated = np.ones(len(dataset), dtype=bool)
+            not_evaluated[eval_order] = False
+            out_label_ids[not_evaluated] = 0
+            preds = all_reduce_sum(preds)
+            out_label_ids = all_reduce_sum(out_label_ids)
+            eval_loss, nb_eval_steps = all_reduce_sum(np.array([eval_loss, nb_eval_steps], dtype=np.float64))
+
+        if token_level:
+            mask = out_label_ids != self.pad_token_label_id
+            scores = self.span_metrics[task].score(out_label_ids[mask], preds[mask], mask.sum(axis=1))
+        else:
+            scores = ConfusionMatrix(out_label_ids, preds, len(self.label_vocabs[task]))
+        return eval_loss / nb_eval_steps, scores.summary(), scores
+
+    def evaluate(self, mode, step, show_detail=False):
+        """
+        Evaluates every task; the scores are prefixed with the task name and "loss" is the mean task loss.
+        """
+        if mode == 'test':
+            datasets = self.test_datasets
+        elif mode == 'dev':
+            datasets = self.dev_datasets
+        else:
+            raise Exception("Only dev and test dataset available")
+
+        logger.info("***** Running evaluation on %s dataset *****", mode)
+        # Evaluate with the unwrapped model: processes may run different numbers of batches
+        model = self.model.module if hasattr(self.model, 'module') else self.model
+        model.eval()
+
+        results = {}
+        task_losses = []
+        details = {}
+        for task in self.tasks:
+            task_loss, scores, details[task] = self._evaluate_task(task, datasets[task], model)
+            task_losses.append(task_loss)
+            results["{}_loss".format(task)] = task_loss
+            results.update(("{}_{}".format(task, key), value) for key, value in scores.items())
+        results["loss"] = float(np.mean(task_losses))
+
+        if not is_main_process():
+            return results
+
+        logger.info("***** Eval results *****")
+        print("***** Eval results *****")
+        for key in sorted(results.keys()):
+            logger.info("  %s = %s", key, str(results[key]))
+            print("\t{} = {}".format(key, str(results[key])))
+        if show_detail:
+            for task in self.tasks:
+                if task in SEQUENCE_TASKS:
+                    report = str(details[task].to_frame(self.label_vocabs[task].labels))
+                else:
+                    report = details[task].report()
+                logger.info("\n[%s]\n%s", task, report)
+                print("\n[{}]\n{}".format(task, report))
+
+        return results
+
+    def save_model(self, wait=True):
+        """
+        Save model checkpoint (Overwrite); only the main process writes.
+        Args:
+            wait: Block until the files are written. Otherwise a CPU snapshot of the weights is written
+                by the background writer while training goes on.
+        """
+        if not is_main_process():
+            return
+        model_to_save = self.model.module if hasattr(self.model, 'module') else self.model
+        logger.info("Saving model checkpoint to %s", self.args["model_dir"])
+        self.checkpoint_writer.submit("model checkpoint to {}".format(self.args["model_dir"]), self._write_model,
+                                      model_to_save, snapshot_to_cpu(model_to_save.state_dict()), dict(self.args))
+        if wait:
+            self.checkpoint_writer.wait()
+
+    def _write_model(self, model_to_save, state_dict, args):
+        model_to_save.save_pretrained(args["model_dir"], state_dict=state_dict)
+
+        # Save training arguments together with the trained model
+        torch.save(args, os.path.join(args["model_dir"], 'training_args.bin'))
+
+    def load_model(self):
+        # Check whether model exists
+        if not os.path.exists(self.args["model_dir"]):
+            raise Exception("Model doesn't exists! Train first!")
+
+        try:
+            self.model = MultiTaskModel.from_pretrained(self.args["model_dir"], self.encoder_class)
+            self.model.to(self.device)
+            logger.info("***** Model Loaded *****")
+        except:
+            raise Exception("Some model files might be missing...")
@@ -3,14 +3,23 @@ import shutil
 import logging
 from tqdm import tqdm, trange
 import pdb
+from contextlib import nullcontext
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
 from torch.nn import CrossEntropyLoss
-from transformers import AdamW, get_linear_schedule_with_warmup
 
-from utils import compute_metrics_tlink, get_labels, get_test_texts, show_report_tlink, MODEL_CLASSES
+from batching import LengthBucketSampler
+from checkpoint import (AsyncCheckpointWriter, latest_checkpoint, save_training_checkpoint,
+                        restore_training_checkpoint, snapshot_to_cpu)
+from distributed import is_distributed, is_main_process, get_rank, get_world_size, get_local_rank, all_reduce_sum
+from mixed_precision import MixedPrecision
+from step_profiler import StepProfiler
+from metrics import ConfusionMatrix
+from label_vocab import get_label_vocab
+from utils import get_test_texts, MODEL_CLASSES
 
 logger = logging.getLogger(__name__)
 
@@ -22,21 +31,27 @@ class Trainer(object):
         self.dev_dataset = dev_dataset
         self.test_dataset = test_dataset
 
-        self.label_lst = get_labels(args)
+        self.label_vocab = get_label_vocab(args)
+        self.label_lst = self.label_vocab.labels
         self.num_labels = len(self.label_lst)
         self.pad_token_label_id = torch.nn.CrossEntropyLoss().ignore_index
 
         self.config_class, self.model_class, _ = MODEL_CLASSES[args["model_type"]]
+        self.uses_entity_starts = getattr(self.model_class, "uses_entity_starts", False)
 
         self.config = self.config_class.from_pretrained(args["model_name_or_path"],
                                                         num_labels=self.num_labels,
                                                         finetuning_task=args["task"],
-                                                        id2label={str(i): label for i, label in enumerate(self.label_lst)},
-                                                        label2id={label: i for i, label in enumerate(self.label_lst)})
+                                                        id2label=self.label_vocab.id2label(),
+                                                        label2id=self.label_vocab.label2id())
         self.model = self.model_class.from_pretrained(args["model_name_or_path"], config=self.config)
 
-        # GPU or CPU
-        self.device = "cuda" if torch.cuda.is_available() and not args["no_cuda"] else "cpu"
+        # GPU or CPU; one GPU per process when distributed (torchrun)
+        self.rank, self.world_size = get_rank(), get_world_size()
+        if torch.cuda.is_available() and not args["no_cuda"]:
+            self.device = "cuda:{}".format(get_local_rank()) if is_distributed() else "cuda"
+        else:
+            self.device = "cpu"
        
         # class weights
         self.class_weights = class_weights
@@ -48,28 +63,48 @@ class Trainer(object):
             self.model.resize_token_embeddings(len(tokenizer))
         
         self.model.to(self.device)
+        self.precision = MixedPrecision(args["mixed_precision"], torch.device(self.device).type)
+        # Full training states (optimizer, scheduler, RNG, ...) to resume an interrupted run from
+        self.checkpoint_dir = os.path.join(args["model_dir"], "checkpoints")
+        # Checkpoints are written from a CPU snapshot on a background thread while training goes on
+        self.checkpoint_writer = AsyncCheckpointWriter()
 
+        self.eval_logits = None
         self.test_texts = None
         if args["write_pred"]:
             self.test_texts = get_test_texts(args, for_tlink=True)
-            if os.path.exists(args["pred_dir"]):
+            if os.path.exists(args["pred_dir"]) and is_main_process():
                 shutil.rmtree(args["pred_dir"])
 
-    def _compute_logits_loss(self, batch):
+    def _compute_logits_loss(self, batch, model=None):
+        if model is None:
+            model = self.model
         batch = tuple(t.to(self.device) for t in batch)  # GPU or CPU
         inputs = {'input_ids': batch[0],
                   'attention_mask': batch[1],
                   'labels': batch[3]}
         if self.args["model_type"] != 'distilkobert':
             inputs['token_type_ids'] = batch[2]
-        outputs = self.model(**inputs)
+        if self.uses_entity_starts:
+            # Positions of [B1] and [B2], for the entity marker heads
+            inputs['entity_starts'] = batch[4]
+        with self.precision.autocast():
+            outputs = model(**inputs)
         loss, logits = outputs[0], outputs[1]
         labels = batch[3]
         return logits, loss, labels
 
     def train(self):
-        train_sampler = RandomSampler(self.train_dataset)
-        train_dataloader = DataLoader(self.train_dataset, sampler=train_sampler, batch_size=self.args["train_batch_size"])
+        from transformers import AdamW, get_linear_schedule_with_warmup
+
+        # Shuffle within length buckets so each batch is padded only to its own longest example
+        train_sampler = LengthBucketSampler(self.train_dataset.lengths, self.args["train_batch_size"],
+                                            shuffle=True, seed=self.args["seed"],
+                                            num_replicas=self.world_size, rank=self.rank)
+        # Its own generator: every new DataLoader iterator draws a seed, which must not shift the global
+        # torch RNG (dropout) when a resumed run starts in the middle of an epoch
+        train_dataloader = DataLoader(self.train_dataset, batch_sampler=train_sampler, collate_fn=self.train_dataset.collate,
+                                      generator=torch.Generator().manual_seed(self.args["seed"]))
 
         if self.args["max_steps"] > 0:
             t_total = self.args["max_steps"]
@@ -77,6 +112,10 @@ class Trainer(object):
         else:
             t_total = len(train_dataloader) // self.args["gradient_accumulation_steps"] * self.args["num_train_epochs"]
 
+        if is_distributed():
+            # Gradients are averaged over the processes during backward
+            self.model = DistributedDataParallel(self.model, device_ids=None if self.device == "cpu" else [get_local_rank()])
+
         # Prepare optimizer and schedule (linear warmup and decay)
         no_decay = ['bias', 'LayerNorm.weight']
         optimizer_grouped_parameters = [
@@ -91,7 +130,8 @@ class Trainer(object):
         logger.info("***** Running training *****")
         logger.info("  Num examples = %d", len(self.train_dataset))
         logger.info("  Num Epochs = %d", self.args["num_train_epochs"])
-        logger.info("  Total train batch size = %d", self.args["train_batch_size"])
+        logger.info("  Num processes = %d", self.world_size)
+        logger.info("  Total train batch size = %d", self.args["train_batch_size"] * self.world_size)
         logger.info("  Gradient Accumulation steps = %d", self.args["gradient_accumulation_steps"])
         logger.info("  Total optimization steps = %d", t_total)
         logger.info("  Logging steps = %d", self.args["logging_steps"])
@@ -100,52 +140,98 @@ class Trainer(object):
 
         global_step = 0
         tr_loss = 0.0
-        self.model.zero_grad()
-
-        train_iterator = trange(int(self.args["num_train_epochs"]), desc="Epoch")
-
+        start_epoch, start_batch = 0, 0
         to_stop = False
         trigger_times = 0
         last_loss = None
+        self.model.zero_grad()
+
+        checkpoint = latest_checkpoint(self.checkpoint_dir) if self.args["resume"] else None
+        if checkpoint is not None:
+            model = self.model.module if hasattr(self.model, 'module') else self.model
+            counters = restore_training_checkpoint(checkpoint, model, optimizer, scheduler, self.precision)
+            global_step, tr_loss = counters["global_step"], counters["tr_loss"]
+            start_epoch, start_batch = counters["epoch"], counters["batch_in_epoch"]
+            trigger_times, last_loss, to_stop = counters["trigger_times"], counters["last_loss"], counters["to_stop"]
+        elif self.args["resume"]:
+            logger.info("No checkpoint in %s, training from scratch", self.checkpoint_dir)
+
+        # Per-step timings and throughput (args["profile_file"]), optionally a torch.profiler trace window
+        if is_main_process():
+            profiler = StepProfiler(self.args["profile_file"], self.args["torch_profile_steps"], self.device,
+                                    trace_dir=self.args["model_dir"])
+        else:
+            profiler = StepProfiler()
+        profiler.start()
+
+        train_iterator = trange(start_epoch, int(self.args["num_train_epochs"]), desc="Epoch", disable=not is_main_process())
+
         patience = self.args['patience']
-        for ei, _ in enumerate(train_iterator):
-            print("[Epoch] {}/{}".format(ei+1, self.args['num_train_epochs']))
-            epoch_iterator = tqdm(train_dataloader, desc="Iteration")
-            for step, batch in enumerate(epoch_iterator):
+        for ei in train_iterator:
+            if to_stop:
+                break
+            # The batches before start_batch were trained on before the checkpoint we resumed from
+            train_sampler.set_epoch(ei, start_batch if ei == start_epoch else 0)
+            if is_main_process():
+                print("[Epoch] {}/{}".format(ei+1, self.args['num_train_epochs']))
+            epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=not is_main_process())
+            profiler.epoch_begin()
+            for step, batch in enumerate(epoch_iterator, start_batch if ei == start_epoch else 0):
+                profiler.step_begin(global_step)
                 self.model.train()
-                batch = tuple(t.to(self.device) for t in batch)  # GPU or CPU
+                num_tokens = int(batch[1].sum()) if profiler.enabled else 0  # Non-pad tokens
+                with profiler.phase("h2d"):
+                    batch = tuple(t.to(self.device) for t in batch)  # GPU or CPU
 
-                logits, loss, labels = self._compute_logits_loss(batch)
+                # Only all-reduce the gradients on the last micro-batch of an accumulation window
+                accumulating = (step + 1) % self.args["gradient_accumulation_steps"] != 0
+                with self.model.no_sync() if is_distributed() and accumulating else nullcontext():
+                    with profiler.phase("forward"):
+                        logits, loss, labels = self._compute_logits_loss(batch)
 
-                if self.args["gradient_accumulation_steps"] > 1:
-                    loss = loss / self.args["gradient_accumulation_steps"]
+                        if self.args["gradient_accumulation_steps"] > 1:
+                            loss = loss / self.args["gradient_accumulation_steps"]
 
-                loss.backward()
+                    with profiler.phase("backward"):
+                        self.precision.backward(loss)
 
                 tr_loss += loss.item()
                 if (step + 1) % self.args["gradient_accumulation_steps"] == 0:
-                    torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.args["max_grad_norm"])
-
-                    optimizer.step()
-                    scheduler.step()  # Update learning rate schedule
-                    self.model.zero_grad()
+                    with profiler.phase("optimizer"):
+                        self.precision.step(optimizer, self.model.parameters(), self.args["max_grad_norm"])
+                        scheduler.step()  # Update learning rate schedule
+                        self.model.zero_grad()
                     global_step += 1
 
                     if self.args["logging_steps"] > 0 and global_step % self.args["logging_steps"] == 0:
-                        eval_results = self.evaluate("dev", global_step)
+                        with profiler.phase("eval"):
+                            eval_results = self.evaluate("dev", global_step)
                         eval_loss = eval_results['loss']
                         if last_loss == None or eval_loss > last_loss:
                             trigger_times += 1
                         last_loss = eval_loss
-                        print("model checked with dev dataset (eval loss: {}, #trigger: {}/{})".format(eval_loss, trigger_times, patience))
+                        if is_main_process():
+                            print("model checked with dev dataset (eval loss: {}, #trigger: {}/{})".format(eval_loss, trigger_times, patience))
                         if patience >0 and trigger_times >= patience:
-                            print("Early stopped!")
+                            if is_main_process():
+                                print("Early stopped!")
                             to_stop = True
 
                     if self.args["save_steps"] > 0 and global_step % self.args["save_steps"] == 0:
-                        self.save_model()
-                        print("model saved.")
-
+                        with profiler.phase("save"):
+                            self.save_model(wait=False)
+                        if is_main_process():
+                            print("model saving in the background.")
+
+                    if self.args["checkpoint_steps"] > 0 and global_step % self.args["checkpoint_steps"] == 0:
+                        model = self.model.module if hasattr(self.model, 'module') else self.model
+                        counters = {"global_step": global_step, "epoch": ei, "batch_in_epoch": step + 1, "tr_loss": tr_loss,
+                                    "trigger_times": trigger_times, "last_loss": last_loss, "to_stop": to_stop}
+                        with profiler.phase("save"):
+                            save_training_checkpoint(self.checkpoint_dir, model, optimizer, scheduler, self.precision,
+                                                     counters, self.args["keep_checkpoints"], self.checkpoint_writer)
+
+                profiler.step_end(global_step, ei, len(batch[0]), num_tokens)
                 if to_stop:
                     break
 
@@ -157,9 +243,15 @@ class Trainer(object):
                 train_iterator.close()
                 break
 
+        profiler.close()
+        self.checkpoint_writer.wait()
         return global_step, tr_loss / global_step
 
-    def evaluate(self, mode, step, show_detail=False):
+    def evaluate(self, mode, step, show_detail=False, keep_logits=False):
+        """
+        Args:
+            keep_logits: Also keep the [num_examples, num_labels] logits in `self.eval_logits`.
+        """
         if mode == 'test':
             dataset = self.test_dataset
         elif mode == 'dev':
@@ -167,8 +259,12 @@ class Trainer(object):
         else:
             raise Exception("Only dev and test dataset available")
 
-        eval_sampler = SequentialSampler(dataset)
-        eval_dataloader = DataLoader(dataset, sampler=eval_sampler, batch_size=self.args["eval_batch_size"])
+        # Batches are sorted by length; eval_order maps them back to the dataset order.
+        # When distributed, each process evaluates every world_size-th batch and the results are summed up.
+        eval_batches = LengthBucketSampler(dataset.lengths, self.args["eval_batch_size"], shuffle=False).batches()
+        eval_batches = eval_batches[self.rank::self.world_size]
+        eval_dataloader = DataLoader(dataset, batch_sampler=eval_batches, collate_fn=dataset.collate)
+        eval_order = np.concatenate(eval_batches) if eval_batches else np.zeros(0, dtype=np.int64)
 
         # Eval!
         logger.info("***** Running evaluation on %s dataset *****", mode)
@@ -176,41 +272,50 @@ class Trainer(object):
         logger.info("  Batch size = %d", self.args["eval_batch_size"])
         eval_loss = 0.0
         nb_eval_steps = 0
-        preds = None
-        out_label_ids = None
+        # Predictions are argmax-ed on the device and written by example index
+        preds = np.zeros(len(dataset), dtype=np.int64)
+        out_label_ids = np.zeros(len(dataset), dtype=np.int64)
+        self.eval_logits = np.zeros((len(dataset), self.num_labels), dtype=np.float32) if keep_logits else None
+        num_seen = 0
 
-        self.model.eval()
+        # Evaluate with the unwrapped model: processes may run different numbers of batches
+        model = self.model.module if hasattr(self.model, 'module') else self.model
+        model.eval()
 
-        for batch in tqdm(eval_dataloader, desc="Evaluating"):
+        for batch in tqdm(eval_dataloader, desc="Evaluating", disable=not is_main_process()):
             batch = tuple(t.to(self.device) for t in batch)
             with torch.no_grad():
-                logits, loss, labels = self._compute_logits_loss(batch)
+                logits, loss, labels = self._compute_logits_loss(batch, model)
                 eval_loss += loss.mean().item()
 
             nb_eval_steps += 1
 
-            if preds is None:
-                preds = logits.detach().cpu().numpy()
-                out_label_ids = labels.detach().cpu().numpy()
-            else:
-                preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-                out_label_ids = np.append(out_label_ids, labels.detach().cpu().numpy(), axis=0)
+            batch_index = eval_order[num_seen:num_seen + logits.shape[0]]
+            preds[batch_index] = logits.argmax(dim=-1).cpu().numpy()
+            out_label_ids[batch_index] = labels.cpu().numpy()
+            if keep_logits:
+                self.eval_logits[batch_index] = logits.float().cpu().numpy()
+            num_seen += logits.shape[0]
+
+        if is_distributed():
+            # Every process filled only the rows of its own batches (zero elsewhere); sum over the processes
+            preds = all_reduce_sum(preds)
+            out_label_ids = all_reduce_sum(out_label_ids)
+            if keep_logits:
+                self.eval_logits = all_reduce_sum(self.eval_logits)
+            # The same mean batch loss on every process, so early stopping agrees
+            eval_loss, nb_eval_steps = all_reduce_sum(np.array([eval_loss, nb_eval_steps], dtype=np.float64))
 
         eval_loss = eval_loss / nb_eval_steps
         results = {
             "loss": eval_loss
         }
 
-        preds = np.argmax(preds, axis=1)
-        slot_label_map = {i: label for i, label in enumerate(self.label_lst)}
-        out_label_list = []
-        preds_list = []
-
-        for i in range(out_label_ids.shape[0]):
-            out_label_list.append(slot_label_map[out_label_ids[i]])
-            preds_list.append(slot_label_map[preds[i]])
+        label_names = np.array(self.label_lst, dtype=object)
+        out_label_list = label_names[out_label_ids].tolist()
+        preds_list = label_names[preds].tolist()
 
-        if self.args["write_pred"]:
+        if self.args["write_pred"] and is_main_process():
             if not os.path.exists(self.args["pred_dir"]):
                 os.mkdir(self.args["pred_dir"])
 
@@ -218,8 +323,12 @@ class Trainer(object):
                 for text, true_label, pred_label in zip(self.test_texts, out_label_list, preds_list):
                     f.write("{} {} {}\n".format(text, true_label, pred_label))
 
-        result = compute_metrics_tlink(out_label_ids, preds)
-        results.update(result)
+        # One confusion matrix gives both the scores and the detailed report
+        confusion = ConfusionMatrix(out_label_ids, preds, self.num_labels)
+        results.update(confusion.summary())
+
+        if not is_main_process():
+            return results
 
         logger.info("***** Eval results *****")
         print("***** Eval results *****")
@@ -227,20 +336,33 @@ class Trainer(object):
             logger.info("  %s = %s", key, str(results[key]))
             print("\t{} = {}".format(key, str(results[key])))
         if show_detail:
-            print(show_report_tlink(out_label_list, preds_list, self.label_lst))
+            print(confusion.to_frame(self.label_lst))
 
         return results
 
-    def save_model(self):
-        # Save model checkpoint (Overwrite)
-        if not os.path.exists(self.args["model_dir"]):
-            os.makedirs(self.args["model_dir"])
+    def save_model(self, wait=True):
+        """
+        Save model checkpoint (Overwrite); only the main process writes.
+        Args:
+            wait: Block until the files are written. Otherwise a CPU snapshot of the weights is written
+                by the background writer while training goes on.
+        """
+        if not is_main_process():
+            return
         model_to_save = self.model.module if hasattr(self.model, 'module') else self.model
-        model_to_save.save_pretrained(self.args["model_dir"])
+        logger.info("Saving model checkpoint to %s", self.args["model_dir"])
+        self.checkpoint_writer.submit("model checkpoint to {}".format(self.args["model_dir"]), self._write_model,
+                                      model_to_save, snapshot_to_cpu(model_to_save.state_dict()), dict(self.args))
+        if wait:
+            self.checkpoint_writer.wait()
+
+    def _write_model(self, model_to_save, state_dict, args):
+        if not os.path.exists(args["model_dir"]):
+            os.makedirs(args["model_dir"])
+        model_to_save.save_pretrained(args["model_dir"], state_dict=state_dict)
 
         # Save training arguments together with the trained model
-        torch.save(self.args, os.path.join(self.args["model_dir"], 'training_args.bin'))
-        logger.info("Saving model checkpoint to %s", self.args["model_dir"])
+        torch.save(args, os.path.join(args["model_dir"], 'training_args.bin'))
 
     def load_model(self):
         # Check whether model exists
@@ -1,39 +1,54 @@
 import os
 import random
 import logging
+import importlib
+from collections.abc import Mapping
 
-import torch
 import numpy as np
-from seqeval.metrics import precision_score, recall_score, f1_score, classification_report
-from sklearn.metrics import confusion_matrix 
-from datasets import load_metric
-import pandas as pd
 import pdb
 
-from transformers import (
-    BertConfig,
-    DistilBertConfig,
-    ElectraConfig,
-    ElectraTokenizer,
-    BertTokenizer,
-    BertForTokenClassification,
-    BertForSequenceClassification,
-    DistilBertForTokenClassification,
-    ElectraForTokenClassification,
-    ElectraForSequenceClassification
-)
-from tokenization_kobert import KoBertTokenizer
-
-MODEL_CLASSES = {
-    'kobert': (BertConfig, BertForTokenClassification, KoBertTokenizer),
-    'kobert-tlink': (BertConfig, BertForSequenceClassification, KoBertTokenizer),
-    'distilkobert': (DistilBertConfig, DistilBertForTokenClassification, KoBertTokenizer),
-    'bert': (BertConfig, BertForTokenClassification, BertTokenizer),
-    'kobert-lm': (BertConfig, BertForTokenClassification, KoBertTokenizer),
-    'koelectra-base': (ElectraConfig, ElectraForTokenClassification, ElectraTokenizer),
-    'koelectra-base-tlink': (ElectraConfig, ElectraForSequenceClassification, ElectraTokenizer),
-    'koelectra-small': (ElectraConfig, ElectraForTokenClassification, ElectraTokenizer),
-}
+from metrics import ConfusionMatrix
+from label_vocab import get_label_vocab
+
+
+class LazyModelClasses(Mapping):
+    """
+    Maps a model type to its (config, model, tokenizer) classes. The classes are given as
+    "module.Class" names and imported on first access, so that importing utils does not pull in
+    every transformers model.
+    """
+
+    def __init__(self, class_names):
+        self.class_names = class_names
+        self.resolved = {}
+
+    def __getitem__(self, model_type):
+        if model_type not in self.resolved:
+            self.resolved[model_type] = tuple(getattr(importlib.import_module(module), name)
+                                              for module, name in (path.rsplit(".", 1) for path in self.class_names[model_type]))
+        return self.resolved[model_type]
+
+    def __iter__(self):
+        return iter(self.class_names)
+
+    def __len__(self):
+        return len(self.class_names)
+
+
+MODEL_CLASSES = LazyModelClasses({
+    'kobert': ('transformers.BertConfig', 'transformers.BertForTokenClassification', 'tokenization_kobert.KoBertTokenizer'),
+    'kobert-tlink': ('transformers.BertConfig', 'transformers.BertForSequenceClassification', 'tokenization_kobert.KoBertTokenizer'),
+    'distilkobert': ('transformers.DistilBertConfig', 'transformers.DistilBertForTokenClassification', 'tokenization_kobert.KoBertTokenizer'),
+    'bert': ('transformers.BertConfig', 'transformers.BertForTokenClassification', 'transformers.BertTokenizer'),
+    'kobert-lm': ('transformers.BertConfig', 'transformers.BertForTokenClassification', 'tokenization_kobert.KoBertTokenizer'),
+    'koelectra-base': ('transformers.ElectraConfig', 'transformers.ElectraForTokenClassification', 'transformers.ElectraTokenizer'),
+    'koelectra-base-tlink': ('transformers.ElectraConfig', 'transformers.ElectraForSequenceClassification', 'transformers.ElectraTokenizer'),
+    'kobert-tlink-em': ('transformers.BertConfig', 'modeling_tlink.BertForEntityMarkerClassification', 'tokenization_kobert.KoBertTokenizer'),
+    'koelectra-base-tlink-em': ('transformers.ElectraConfig', 'modeling_tlink.ElectraForEntityMarkerClassification', 'transformers.ElectraTokenizer'),
+    'kobert-multitask': ('transformers.BertConfig', 'transformers.BertModel', 'tokenization_kobert.KoBertTokenizer'),
+    'koelectra-base-multitask': ('transformers.ElectraConfig', 'transformers.ElectraModel', 'transformers.ElectraTokenizer'),
+    'koelectra-small': ('transformers.ElectraConfig', 'transformers.ElectraForTokenClassification', 'transformers.ElectraTokenizer'),
+})
 MODEL_PATH_MAP = {
     'kobert': 'monologg/kobert',
     'kobert-tlink': 'monologg/kobert',
@@ -42,6 +57,10 @@ MODEL_PATH_MAP = {
     'kobert-lm': 'monologg/kobert-lm',
     'koelectra-base': 'monologg/koelectra-base-discriminator',
     'koelectra-base-tlink': 'monologg/koelectra-base-discriminator',
+    'kobert-tlink-em': 'monologg/kobert',
+    'koelectra-base-tlink-em': 'monologg/koelectra-base-discriminator',
+    'kobert-multitask': 'monologg/kobert',
+    'koelectra-base-multitask': 'monologg/koelectra-base-discriminator',
     'koelectra-small': 'monologg/koelectra-small-discriminator',
 }
 
@@ -63,8 +82,8 @@ def get_test_texts(args, for_tlink=False):
 
 
 def get_labels(args):
-    ret = [label.strip() for label in open(os.path.join(args["data_dir"], args["label_file"]), 'r', encoding='utf-8')]
-    return ret
+    # The label file is read once per process and shared through label_vocab.get_label_vocab
+    return list(get_label_vocab(args).labels)
 
 
 def load_tokenizer(args):
@@ -78,6 +97,7 @@ def init_logger():
 
 
 def set_seed(args):
+    import torch
     random.seed(args["seed"])
     np.random.seed(args["seed"])
     torch.manual_seed(args["seed"])
@@ -85,29 +105,37 @@ def set_seed(args):
         torch.cuda.manual_seed_all(args["seed"])
 
 
+def align_predictions(out_label_ids, preds, label_lst, pad_token_label_id):
+    """
+    Drops the padded/sub-word positions (label == pad_token_label_id) with one boolean mask and
+    maps the remaining ids to label strings.
+    Returns:
+        out_label_list, preds_list: one list of label strings per example
+    """
+    mask = out_label_ids != pad_token_label_id
+    split_points = np.cumsum(mask.sum(axis=1))[:-1]
+    label_names = np.array(label_lst, dtype=object)
+    out_label_list = [labels.tolist() for labels in np.split(label_names[out_label_ids[mask]], split_points)]
+    preds_list = [labels.tolist() for labels in np.split(label_names[preds[mask]], split_points)]
+    return out_label_list, preds_list
+
+
 def compute_metrics(labels, preds):
     assert len(preds) == len(labels)
     return f1_pre_rec(labels, preds)
 
-def compute_metrics_tlink(labels, preds):
+def compute_metrics_tlink(labels, preds, num_labels=None):
     assert len(preds) == len(labels)
-    return f1_pre_rec_tlink(labels, preds)
+    return f1_pre_rec_tlink(labels, preds, num_labels)
 
-def f1_pre_rec_tlink(labels, preds):
-    prec, rec, f1 = load_metric('precision'), load_metric('recall'), load_metric('f1')
-    return {
-        "(micro)precision": prec.compute(predictions=preds, references=labels, average='micro'),
-        "(micro)recall": rec.compute(predictions=preds, references=labels, average='micro'),
-        "(micro)f1": f1.compute(predictions=preds, references=labels, average='micro'),
-        "(macro)precision": prec.compute(predictions=preds, references=labels, average='macro'),
-        "(macro)recall": rec.compute(predictions=preds, references=labels, average='macro'),
-        "(macro)f1": f1.compute(predictions=preds, references=labels, average='macro'),
-        "(weighted)precision": prec.compute(predictions=preds, references=labels, average='weighted'),
-        "(weighted)recall": rec.compute(predictions=preds, references=labels, average='weighted'),
-        "(weighted)f1": f1.compute(predictions=preds, references=labels, average='weighted')
-    }
+def f1_pre_rec_tlink(labels, preds, num_labels=None):
+    if num_labels is None:
+        num_labels = int(max(np.max(labels, initial=-1), np.max(preds, initial=-1))) + 1
+    return ConfusionMatrix(labels, preds, num_labels).summary()
 
 def f1_pre_rec(labels, preds):
+    # Reference implementation; the trainer uses the equivalent metrics.SpanMetric on label ids
+    from seqeval.metrics import precision_score, recall_score, f1_score
     return {
         "precision": precision_score(labels, preds, suffix=True),
         "recall": recall_score(labels, preds, suffix=True),
@@ -116,8 +144,13 @@ def f1_pre_rec(labels, preds):
 
 
 def show_report(labels, preds):
+    from seqeval.metrics import classification_report
     return classification_report(labels, preds, suffix=True)
 
 def show_report_tlink(labels, preds, class_names):
-    ret = confusion_matrix(labels, preds, labels=class_names)
-    return pd.DataFrame(ret, index=class_names, columns=class_names)
+    label_map = {label: i for i, label in enumerate(class_names)}
+    # Pairs with a label outside class_names are left out, like sklearn's confusion_matrix(labels=...)
+    pairs = [(label_map[l], label_map[p]) for l, p in zip(labels, preds) if l in label_map and p in label_map]
+    label_ids = np.array([l for l, _ in pairs], dtype=np.int64)
+    pred_ids = np.array([p for _, p in pairs], dtype=np.int64)
+    return ConfusionMatrix(label_ids, pred_ids, len(class_names)).to_frame(class_names)